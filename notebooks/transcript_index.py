@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from langchain.chains import RetrievalQA
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import YoutubeLoader
+from langchain_community.vectorstores import FAISS
+
+# Question answering over video transcripts. Each transcript is split, embedded and
+# saved as a FAISS index under `cache_dir`, keyed by the video url and the embedding
+# model, so later runs (and later questions) only pay for the query:
+#
+#   library = TranscriptLibrary(embeddings, llm, embedding_model="text-embedding-ada-002")
+#   library.ask(youtube_url, "what is the most important point of the video?")
+
+DEFAULT_CACHE_DIR = ".cache/transcripts"
+
+# Splitter settings for transcripts
+CHUNK_SIZE = 10000
+CHUNK_OVERLAP = 200
+
+
+def index_key(url, embedding_model):
+    return hashlib.sha256(f"{embedding_model}\0{url}".encode("utf-8")).hexdigest()[:32]
+
+
+def load_transcript(url, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    documents = YoutubeLoader.from_youtube_url(url).load()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(documents)
+
+
+# Load an index written by FAISS.save_local. The vectors are memory-mapped when the
+# installed faiss supports it for this index type, so opening many transcripts side
+# by side doesn't read them all into memory; otherwise they are read normally.
+def load_index(index_dir, embeddings):
+    import faiss
+
+    index_path = os.path.join(index_dir, "index.faiss")
+    # newer faiss releases can also map the codes of flat indexes
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    try:
+        index = faiss.read_index(index_path, mmap_flag)
+    except RuntimeError:
+        index = faiss.read_index(index_path)
+    # only ever load pickles this module wrote itself
+    with open(os.path.join(index_dir, "index.pkl"), "rb") as docstore_file:
+        docstore, index_to_docstore_id = pickle.load(docstore_file)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+# Persistent FAISS indexes over video transcripts, with one RetrievalQA chain per
+# index built on first use and reused for every later question
+class TranscriptLibrary:
+    def __init__(self, embeddings, llm, embedding_model, cache_dir=DEFAULT_CACHE_DIR,
+                 chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+        self.embeddings = embeddings
+        self.llm = llm
+        self.embedding_model = embedding_model
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._stores = {}
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def index_dir(self, url):
+        return os.path.join(self.cache_dir, index_key(url, self.embedding_model))
+
+    def _manifest(self, url):
+        return {"url": url,
+                "embedding_model": self.embedding_model,
+                "chunk_size": self.chunk_size,
+                "chunk_overlap": self.chunk_overlap}
+
+    def _is_current(self, index_dir, url):
+        manifest_path = os.path.join(index_dir, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            return json.load(manifest_file) == self._manifest(url)
+
+    # Fetch, split and embed the transcript, then save the index and its manifest
+    def build(self, url):
+        index_dir = self.index_dir(url)
+        chunks = load_transcript(url, self.chunk_size, self.chunk_overlap)
+        vector_store = FAISS.from_documents(chunks, self.embeddings)
+        vector_store.save_local(index_dir)
+        # written last, so an interrupted build is redone on the next run
+        with open(os.path.join(index_dir, "manifest.json"), "w", encoding="utf-8") as manifest_file:
+            json.dump(self._manifest(url), manifest_file)
+        return vector_store
+
+    # The vector store for a url: already open, saved on disk, or built now
+    def index(self, url, rebuild=False):
+        with self._lock:
+            if not rebuild and url in self._stores:
+                return self._stores[url]
+            index_dir = self.index_dir(url)
+            if not rebuild and self._is_current(index_dir, url):
+                vector_store = load_index(index_dir, self.embeddings)
+            else:
+                vector_store = self.build(url)
+            self._stores[url] = vector_store
+            self._chains.pop(url, None)
+            return vector_store
+
+    def chain(self, url):
+        vector_store = self.index(url)
+        with self._lock:
+            qa = self._chains.get(url)
+            if qa is None:
+                qa = self._chains[url] = RetrievalQA.from_chain_type(
+                    llm=self.llm, chain_type="stuff", retriever=vector_store.as_retriever())
+            return qa
+
+    def ask(self, url, question):
+        return self.chain(url).invoke(question)
@@ -1,20 +1,23 @@
 
 import os
+import uuid
 from dotenv import load_dotenv
 import streamlit as st
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Qdrant
-from langchain_openai import OpenAIEmbeddings
-from langchain_openai import ChatOpenAI, OpenAI
-from qdrant_client import QdrantClient, models
-import qdrant_client
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import PromptTemplate, FewShotPromptTemplate
 from streamlit_extras.stylable_container import stylable_container
-import logging
-logging.basicConfig(level=logging.DEBUG)
+from lease_chain import trim_history
+from resources import (get_retrieval_chain, get_answer_cache, get_answer_cache_namespace,
+                       get_event_loop_thread, use_async_pipeline, init_telemetry,
+                       get_stage_handler, start_warmup, get_page_index, get_history_store,
+                       get_single_flight, get_lexical_index)
+from history_store import PAGE_SIZE
+from lexical_index import citations_in
+from single_flight import flight_key
+from page_index import format_page_param
+from telemetry import configure_logging, metrics, record_cache, span
+import time
+configure_logging()
 
 # Set up Streamlit page configuration-
 st.set_page_config(page_title=None,
@@ -23,35 +26,6 @@ st.set_page_config(page_title=None,
                    initial_sidebar_state="auto",
                    menu_items=None)
 
-# Set the model name for LLM
-OPENAI_MODEL = "gpt-4o-mini"
-
-# Store API key as a variable
-openai_api_key = st.secrets["LEASE_OPENAI_API_KEY"]
-
-# Define function to access Qdrant vector store
-def get_vector_store():
-    #Create a client to connect to Qdrant server
-    client = qdrant_client.QdrantClient(
-        st.secrets["QDRANT_HOST"],
-        api_key=st.secrets["QDRANT_API_KEY"]
-        )
-    
-    #initialize embeddings for vector store
-    embeddings = OpenAIEmbeddings(
-        api_key=openai_api_key,
-        model="text-embedding-3-large"
-    )
-    
-    #create a vector store with Qdrant and embeddings
-    vector_store = Qdrant(
-        client = client,
-        collection_name = st.secrets["QDRANT_COLLECTION_NAME"],
-        embeddings = embeddings,
-    )
-    
-    return vector_store
-
 # Define context (not sure if it causes issues that this is separate and in the prompt template)
 context = """You are an expert leases chatbot. You answer questions relating to ASC 842 under US GAAP. Users rely on you to be accurate and thorough in your responses. Please follow the following instructions in constructing your responses:
 1.	You respond to the queries as shown in the provided examples. The responses do not have to be brief. Giving a thorough response is more important than brevity. 
@@ -63,129 +37,46 @@ context = """You are an expert leases chatbot. You answer questions relating to
 7.	If the question is not on the topic of leases, respond by saying, "This is outside the scope of what I can help you with. Let's get back to lease accounting."""
 
 
-# Create function to setup prompt template
-def setup_prompt_template():
-    prefix="""You are an expert leases chatbot. You answer questions relating to ASC 842 under US GAAP. Users rely on you to be accurate and thorough in your responses. Please follow the following instructions in constructing your responses:
-1.	You respond to the queries as shown in the provided examples. The responses do not have to be brief. Giving a thorough response is more important than brevity. 
-2.	If your response refers to an example provided, the response needs to include the full example being referenced.
-3.	Your responses will be provided only from the provided vector store source context documents. 
-4.	Your responses will be clear and helpful and will use language that is easy to understand. 
-5.	Your responses will include examples and potential scenarios.  
-6.	If the answer is not available in the vector store source documents, the response will be "I can share general knowledge about lease accounting, but I cannot advise on specific scenarios, please seek guidance from a qualified expert." 
-7.	If the question is not on the topic of leases, respond by saying, "This is outside the scope of what I can help you with. Let's get back to lease accounting.
-8.  Your responses will not include page number references to the KPMG guidance or to the ASC guidance. Your page number references to date have been hallucinations and are not reliable.
- 
-    
-You will answer the input question based on the provided context:
-    
-    <context>
-    {context}
-    </context>
-    
-You will use the provided examples for guidance on how to construct your responses. Your responses should be similar.
-"""
-     
-     # Define examples to instruct app how to respond
-    examples = [
-        {
-            "input": "How do I determine the different lease components?",
-            "answer": """To identify the different lease and nonlease components in a lease contract, both lessees and lessors need to follow specific steps outlined in ASC 842.
-For lessees, lease components are elements of the arrangement that provide the lessee with the right to use an identified asset. The right to use an underlying asset is considered a separate lease component if the lessee can benefit from the asset either on its own or together with other readily available resources, and if the asset is not highly dependent on or highly interrelated with other assets in the contract. This determination is crucial in allocating consideration between lease and nonlease components.
-For lessors, the process is similar but with some differences. Lessors must allocate any capitalized costs, such as initial direct costs or contract costs, to the separate lease components or nonlease components to which those costs relate. Lessors also have the option to elect a practical expedient where they can choose not to separate nonlease components from lease components and account for them as a single component under certain conditions.
-To provide a comprehensive understanding, let's look at an example from the KPMG Leases Handbook:
-Example: A lessor enters into a lease contract with a lessee for the use of equipment. The contract includes maintenance services as a nonlease component. The lessor must identify the separate lease component (equipment) and nonlease component (maintenance services) and allocate consideration accordingly. If the maintenance services are considered a predominant component, the lessor may account for them under Topic 606. Otherwise, the lessor would account for the combined component as an operating lease under ASC 842."""
-
-        },
-        {
-            "input": "How do I account for lease modifications?",
-            "answer": """When accounting for lease modifications, both lessees and lessors have specific considerations to take into account. Let's break down the accounting treatment for both parties:
-
-For lessees, when a lease modification occurs, the lessee must assess whether the modification results in a separate lease or not. If it does, the lessee will account for the modification as a separate lease. This involves recognizing a new right-of-use asset and lease liability based on the remeasured consideration for the modified lease.
-
-If the modification does not result in a separate lease, the lessee will need to remeasure the lease liability and adjust the right-of-use asset based on the remaining consideration in the contract. The lessee must also reassess the lease classification at the modification effective date and account for any initial direct costs, lease incentives, and other payments made to or by the lessee in connection with the modification.
-
-Overall, the accounting treatment for lease modifications for lessees involves careful consideration of the impact on the financial statements and compliance with ASC 842 requirements.
-
-
-For lessors, accounting for lease modifications involves several steps and considerations. When a lease modification occurs, the lessor must first determine if the modified contract is still considered a lease or contains a lease. If it does, the lessor needs to assess whether the modification results in a separate contract or not.
-If the modification results in a separate contract, the lessor will account for two separate contracts: the unmodified original contract and the new separate contract. The new separate contract is accounted for in the same manner as any other new lease. This means that the lessor will recognize any selling profit or loss on the modified lease based on the fair value of the underlying asset at the effective date of the modification.
-On the other hand, if the modification does not result in a separate contract, the lessor will need to remeasure and reallocate the remaining consideration in the contract. The lessor must also reassess the lease classification at the modification effective date and account for any initial direct costs, lease incentives, and other payments made to or by the lessor in connection with the modification.
-The accounting treatment for lease modifications will vary depending on whether the lease classification changes and how it changes. It is essential for lessors to carefully evaluate each modification to ensure compliance with ASC 842 guidelines."""
-
-        }
-    ]
-    
-    #Define format for examples:
-    example_format = "\nQuestion: {input}\n\nAnswer: {answer}"
-    
-    example_prompts = [example_format.format(**ex) for ex in examples]
-    
-    example_template = PromptTemplate(input_variables=['input', 'context'],
-                                      template=example_format)
-    
-    full_prompt = f"{prefix}\n\n" + "\n\n".join(example_prompts) + "\n\nQuestion: {input}\n\nAnswer: "
-    
-    # enriched_history = history + [(input, full_prompt)]
-    
-    #Define suffix for query
-    suffix="\n\nQuestion: {input}\nAnswer: "
-    
-    #Construct FewShotPromptTemplate
-    prompt_template = FewShotPromptTemplate(
-                                            examples=examples,
-                                            example_prompt=example_template,
-                                            input_variables=['input','context'],
-                                            prefix=prefix,
-                                            suffix=suffix,
-                                            example_separator="\n\n")
-    return prompt_template
-    
-    
-def create_history_aware_chain(prompt_template,vector_store):    
-    # Create new llm instance
-    llm = ChatOpenAI(api_key=openai_api_key, model=OPENAI_MODEL, temperature=0.0)
-    # Set vector_store as retriever
-    retriever = vector_store.as_retriever()
-    # create history aware retriever that will retrieve relevant 
-    # segments from source docs
-    history_aware_retriever_chain = create_history_aware_retriever(
-        llm, 
-        retriever,
-        prompt_template)
-    return history_aware_retriever_chain
-    
-
-# create document chain with create_stuff_documents_chain. This 
-# tekes the relevant source segments from the history_aware_retriever
-# and "stuffs" them into (something?) that the retrieval chain will reference.
-
-def create_document_chain(prompt_template):
-    # Create new llm instance
-    llm = ChatOpenAI(api_key=openai_api_key, model=OPENAI_MODEL, temperature=0.0)
-    doc_chain = create_stuff_documents_chain(llm, prompt_template)
-    return doc_chain
-    
-
-def create_retrieve_chain(history_aware_chain, document_chain):
-    retrieval_chain = create_retrieval_chain(history_aware_chain, document_chain)
-    return retrieval_chain
-    
-def display_history():
-    with st.sidebar:
-        st.subheader("Session History")
-        for idx, (input, response) in enumerate(reversed(st.session_state.history)):
-            with st.expander(f"Q: {input}"):
-                st.markdown("**Question:**")
-                st.write(input)
-                st.markdown("**Answer:**")
-                st.write(response)
+# Turns passed to trim_history; older turns never fit its token budget anyway
+HISTORY_WINDOW_TURNS = 10
+
+# Sidebar history: one page of question titles at a time. Only the selected entry's
+# answer is read from the store, so a rerun costs the same however long the conversation.
+# A fragment, so opening an entry or paging reruns only the sidebar list and the answer
+# streamed in the main column stays on screen.
+@st.fragment
+def display_history(history_store, session_id):
+    total = history_store.count(session_id)
+    pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+    page = min(st.session_state.get('history_page', 0), pages - 1)
+    for turn_id, question in history_store.titles(session_id, page):
+        title = question if len(question) <= 60 else question[:57] + "..."
+        if st.button(f"Q: {title}", key=f"history_{turn_id}", use_container_width=True):
+            # clicking the open entry again closes it
+            selected = st.session_state.get('history_selected')
+            st.session_state['history_selected'] = None if selected == turn_id else turn_id
+        if st.session_state.get('history_selected') == turn_id:
+            st.markdown("**Question:**")
+            st.write(question)
+            st.markdown("**Answer:**")
+            st.write(history_store.answer(session_id, turn_id))
+    if pages > 1:
+        previous_col, label_col, next_col = st.columns([1, 2, 1])
+        if previous_col.button("‹", key="history_previous", disabled=page == 0):
+            st.session_state['history_page'] = page - 1
+            st.rerun(scope="fragment")
+        label_col.caption(f"Page {page + 1} of {pages}")
+        if next_col.button("›", key="history_next", disabled=page >= pages - 1):
+            st.session_state['history_page'] = page + 1
+            st.rerun(scope="fragment")
 
 # define function to clear chat history
-def clear_history():
-    if 'history' in st.session_state:
-        del st.session_state['history']
+def clear_history(history_store, session_id):
+    history_store.clear(session_id)
+    st.session_state['history_page'] = 0
+    st.session_state['history_selected'] = None
     # reset input and answer
-    st.session_state['input'] = ""
+    st.session_state['input_value'] = ""
     
 def submit_button():
     with stylable_container(
@@ -215,6 +106,63 @@ def clear_button():
     ) as container:
         return st.button("Clear History")   
 
+# Show the guidance segments the answer is grounded on, and remember the cited pages
+# so the guidance viewer can open straight at them
+def display_sources(documents):
+    page_index = get_page_index()
+    cited_pages = page_index.cited_pages(documents)
+    st.session_state['cited_pages'] = cited_pages
+    with st.expander(f"Sources ({len(documents)} guidance excerpts)"):
+        for doc in documents:
+            _, page = page_index.locate(doc)
+            if page is not None:
+                # pdf page metadata is zero-based
+                st.markdown(f"**Page {page + 1}**")
+            st.write(doc.page_content[:500].replace("$", "\$"))
+        if cited_pages:
+            pages = sorted({page for source_pages in cited_pages.values() for page in source_pages})
+            st.page_link("pages/3_KPMG_Lease_Guidance.py",
+                         label=f"View cited pages {format_page_param(pages).replace(',', ', ')} in the handbook",
+                         icon=":material/menu_book:")
+
+# Chunks of the chain's output for these inputs. If another session is already
+# answering the same question, this session follows that run instead of starting
+# its own. Also returns whether this session started the run.
+def response_chunks(retrieval_chain_instance, inputs):
+    config = {'callbacks': [get_stage_handler()]}
+    # resolved here, on the script thread; start() runs on the flight's thread
+    event_loop_thread = get_event_loop_thread() if use_async_pipeline() else None
+
+    def start():
+        if event_loop_thread is not None:
+            # run on the shared event loop; the flight's thread only collects the chunks
+            return event_loop_thread.stream(retrieval_chain_instance.astream(inputs, config=config))
+        return retrieval_chain_instance.stream(inputs, config=config)
+
+    return get_single_flight().subscribe(flight_key(inputs['input'], inputs['chat_history']), start)
+
+# Stream the answer onto the page as tokens arrive instead of waiting for the
+# full completion. The retrieved context arrives before the first answer token,
+# so the sources are shown first.
+def stream_response(retrieval_chain_instance, inputs):
+    answer = ""
+    documents = []
+    answer_placeholder = None
+    start = time.perf_counter()
+    chunks, leader = response_chunks(retrieval_chain_instance, inputs)
+    for chunk in chunks:
+        if 'context' in chunk:
+            documents = chunk['context']
+            display_sources(documents)
+        if 'answer' in chunk:
+            if answer_placeholder is None:
+                metrics.observe("lease_assistant_first_token_seconds", time.perf_counter() - start)
+                st.markdown(f"**Response:** ")
+                answer_placeholder = st.empty()
+            answer += chunk['answer']
+            answer_placeholder.markdown(answer.replace("$", "\$"))
+    return answer, documents, leader
+
 # define streamlit app
 def main():
     st.title('Lease Accounting AI Assistant')
@@ -390,8 +338,8 @@ def main():
  - **Qdrant**: For efficient vector-based document retreival
 
 **Known issues:**
- - Lease assistant does not currently handle follow-up questions well. User must currently enter a full question with all necessary context each time question is submitted. Working on handling follow-up questions.
- - Page references provided are not currently accurate. The source doc page numbers are in the meta data in the vector store. Working on building code to feed in accurate page references.
+ - Follow-up questions are rewritten into standalone questions using a trimmed window of the conversation. Very long conversations only keep the most recent turns.
+ - Page references written into the response text may not be accurate. The Sources panel lists the pages the answer was actually grounded on and opens them in the guidance viewer.
  - Some responses do not provide complete information or include hallucinations.  Currently prompt template includes only two example training responses. Working on adding additional training materials to increase accuracy/completeness.""")
     
     
@@ -404,18 +352,17 @@ def main():
         
         try:
                 
-            #Initialize history before it is accessed
-            if 'history' not in st.session_state:
-                st.session_state['history'] = []
-            
-            #Initialize vector store
-            if 'vector_store' not in st.session_state:
-                st.session_state['vector_store'] = get_vector_store()
-                # st.success('vector store loaded!')
+            #History lives in the shared store, keyed by this session's id
+            if 'session_id' not in st.session_state:
+                st.session_state['session_id'] = uuid.uuid4().hex
+            session_id = st.session_state['session_id']
+            history_store = get_history_store()
             
-            #Initialize prompt template
-            if 'prompt_template' not in st.session_state:
-                st.session_state['prompt_template'] = setup_prompt_template()
+            init_telemetry()
+            start_warmup()
+
+            #Shared retrieval chain, built once per server process (see resources.py)
+            retrieval_chain_instance = get_retrieval_chain()
             
             #bring context into session state
             if 'context' not in st.session_state:
@@ -428,40 +375,80 @@ def main():
             
             user_input = st.text_area("""Ask about lease accounting! The app
                                     remembers your conversation until you click 'Clear History' in the sidebar""", placeholder='Type your question here...')
-            submit_button()
+            submitted = submit_button()
             # submit_button = st.button('Submit')
             st.divider()
 
-            if submit_button and user_input:
-                with st.spinner("Searching the guidance..."):
-                    history_aware_chain = create_history_aware_chain(st.session_state['prompt_template'],st.session_state['vector_store'])
-                    documents_chain = create_document_chain((st.session_state['prompt_template']))
-                    retrieval_chain_instance = create_retrieve_chain(history_aware_chain, documents_chain)
-                    response = retrieval_chain_instance.invoke({
-                        'input': user_input}) 
-                        # 'context': st.session_state['context'], 
-                        # 'chat_history': st.session_state['history']})
-                    modified_response = response['answer'].replace("$", "\$")
+            if submitted and user_input:
+                chat_history = trim_history(history_store.recent(session_id, HISTORY_WINDOW_TURNS))
+                # follow-ups depend on the conversation, so only standalone questions use the answer cache.
+                # Questions citing a codification reference skip it too: the lexical index answers
+                # them without an embedding call, and the cache lookup would add one.
+                cites_reference = bool(citations_in(user_input)) and get_lexical_index() is not None
+                answer_cache = get_answer_cache() if not chat_history and not cites_reference else None
+                # the namespace is None until the corpus has been fingerprinted once
+                cache_namespace = get_answer_cache_namespace() if answer_cache is not None else None
+                if cache_namespace is None:
+                    answer_cache = None
+                cached = None
+                if answer_cache is not None:
+                    cached = answer_cache.lookup(user_input, cache_namespace)
+                    record_cache("answer", cached is not None)
+
+                if cached is not None:
                     st.markdown(f"**Question:** ")
-                    st.write(response['input'])
+                    st.write(user_input)
+                    if cached['pinned']:
+                        st.caption(f"⚡ Pre-answered (similar to: \"{cached['question']}\")")
+                    else:
+                        st.caption(f"Answered from cache (similar to: \"{cached['question']}\")")
+                    display_sources(cached['context'])
                     st.markdown(f"**Response:** ")
-                    st.write(modified_response)
-                    st.session_state.history.append((user_input, response['answer']))
+                    st.write(cached['answer'].replace("$", "\$"))
+                    history_store.append(session_id, user_input, cached['answer'])
+                elif st.session_state.get('stream_responses', True):
+                    st.markdown(f"**Question:** ")
+                    st.write(user_input)
+                    with st.spinner("Searching the guidance..."), span("end_to_end"):
+                        answer, documents, leader = stream_response(retrieval_chain_instance, {
+                            'input': user_input,
+                            'chat_history': chat_history})
+                    # only add to history once the full answer has arrived
+                    history_store.append(session_id, user_input, answer)
+                    # sessions that joined another session's run leave caching to it
+                    if answer_cache is not None and leader:
+                        answer_cache.store(user_input, answer, documents, cache_namespace)
+                else:
+                    with st.spinner("Searching the guidance..."):
+                        inputs = {'input': user_input, 'chat_history': chat_history}
+                        response = {'input': user_input, 'context': [], 'answer': ""}
+                        with span("end_to_end"):
+                            # collect the (possibly shared) run's chunks into the full response
+                            chunks, leader = response_chunks(retrieval_chain_instance, inputs)
+                            for chunk in chunks:
+                                if 'context' in chunk:
+                                    response['context'] = chunk['context']
+                                if 'answer' in chunk:
+                                    response['answer'] += chunk['answer']
+                        modified_response = response['answer'].replace("$", "\$")
+                        st.markdown(f"**Question:** ")
+                        st.write(response['input'])
+                        display_sources(response['context'])
+                        st.markdown(f"**Response:** ")
+                        st.write(modified_response)
+                        history_store.append(session_id, user_input, response['answer'])
+                        if answer_cache is not None and leader:
+                            answer_cache.store(user_input, response['answer'], response['context'], cache_namespace)
                     
                 
             with st.sidebar:
+                st.toggle("Stream responses", value=True, key='stream_responses')
                 clear_chat_history = clear_button()
                 if clear_chat_history:
-                    st.session_state['history'] = []
-                    st.session_state['input_value'] = ""
+                    clear_history(history_store, session_id)
                     
                 st.subheader(f"**Conversation History**")
-                for idx, (question, answer) in enumerate(reversed(st.session_state.history)):
-                    with st.expander(f"Q: {question}"):
-                        st.markdown("**Question:**")
-                        st.write(question)
-                        st.markdown("**Answer:**")
-                        st.write(answer)
+                display_history(history_store, session_id)
 
             
         except Exception as e:
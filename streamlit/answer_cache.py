@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the semantic answer cache (override with the ANSWER_CACHE_* settings)
+DEFAULT_CACHE_PATH = ".cache/answer_cache.sqlite3"
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_TTL_HOURS = 168
+DEFAULT_MAX_ENTRIES = 1000
+
+# Seconds between re-computations of the namespace by NamespaceMonitor
+DEFAULT_NAMESPACE_REFRESH_SECONDS = 300
+
+
+# Fingerprint of the collection contents. Ingestion derives point ids from the chunk
+# content hash, so any change to the indexed guidance changes the set of ids. This
+# scrolls every point id, so the app computes it off the Submit path (NamespaceMonitor).
+def corpus_fingerprint(client, collection_name):
+    point_ids = []
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name,
+                                       with_payload=False,
+                                       with_vectors=False,
+                                       limit=1000,
+                                       offset=offset)
+        point_ids.extend(str(point.id) for point in points)
+        if offset is None:
+            break
+    return fingerprint_point_ids(collection_name, point_ids)
+
+
+# Fingerprint of a set of point ids (also used for exported snapshots)
+def fingerprint_point_ids(collection_name, point_ids):
+    digest = hashlib.sha256(collection_name.encode("utf-8"))
+    for point_id in sorted(point_ids):
+        digest.update(point_id.encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Cached answers are only valid for the same model, prompt and corpus
+def cache_namespace(model_name, prompt_template, fingerprint):
+    prompt_text = prompt_template.format(input="{input}", context="{context}")
+    key = "\n".join([model_name, prompt_text, fingerprint])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Keeps the answer cache namespace current on a background thread. `compute` (which
+# fingerprints the corpus) runs every `interval` seconds and readers take the last
+# value, None until the first one is ready. `on_change(namespace)` runs on the same
+# thread whenever the namespace changes, including the first time.
+class NamespaceMonitor:
+    def __init__(self, compute, interval=DEFAULT_NAMESPACE_REFRESH_SECONDS, on_change=None):
+        self.compute = compute
+        self.interval = float(interval)
+        self.on_change = on_change
+        self.namespace = None
+        self._thread = threading.Thread(target=self._run, name="answer-namespace", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                namespace = self.compute()
+            except Exception:
+                logger.exception("Could not compute the answer cache namespace")
+            else:
+                changed = namespace != self.namespace
+                self.namespace = namespace
+                if changed and self.on_change is not None:
+                    try:
+                        self.on_change(namespace)
+                    except Exception:
+                        logger.exception("Answer cache namespace change handler failed")
+            time.sleep(self.interval)
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Answer cache keyed on question embeddings, stored in SQLite so it survives restarts.
+# A question is a hit when its cosine similarity to a cached question is at least
+# `threshold`. Entries expire after `ttl_hours` and the least recently used entries
+# are evicted once there are more than `max_entries`. Pinned entries (the pre-answered
+# example questions) are exempt from both, but still go when the namespace changes.
+class SemanticAnswerCache:
+    def __init__(self, path, embeddings, threshold=DEFAULT_THRESHOLD,
+                 ttl_hours=DEFAULT_TTL_HOURS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.threshold = float(threshold)
+        self.ttl_seconds = float(ttl_hours) * 3600
+        self.max_entries = int(max_entries)
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                namespace TEXT NOT NULL,
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                sources TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                pinned INTEGER NOT NULL DEFAULT 0
+            )""")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(answers)")]
+        if "pinned" not in columns:
+            # cache files created before entries could be pinned
+            self._conn.execute("ALTER TABLE answers ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_namespace ON answers (namespace)")
+        self._conn.commit()
+        # in-memory copy of the embeddings for the active namespace, so a lookup is
+        # a single matrix product instead of a table scan
+        self._namespace = None
+        self._ids = []
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def _load(self, namespace):
+        rows = self._conn.execute(
+            "SELECT id, embedding FROM answers WHERE namespace = ? AND (pinned = 1 OR created_at >= ?)",
+            (namespace, time.time() - self.ttl_seconds)).fetchall()
+        self._namespace = namespace
+        self._ids = [row[0] for row in rows]
+        if rows:
+            self._matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        else:
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    # Return the cached answer for a similar enough question, or None
+    def lookup(self, question, namespace):
+        vector = _normalize(self.embeddings.embed_query(question))
+        with self._lock:
+            if namespace != self._namespace:
+                self._load(namespace)
+            if not self._ids:
+                return None
+            scores = self._matrix @ vector
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            if similarity < self.threshold:
+                return None
+            row = self._conn.execute(
+                "SELECT question, answer, sources, created_at, pinned FROM answers WHERE id = ?",
+                (self._ids[best],)).fetchone()
+            if row is None or (not row[4] and row[3] < time.time() - self.ttl_seconds):
+                # expired or evicted since the matrix was loaded
+                self._load(namespace)
+                return None
+            self._conn.execute("UPDATE answers SET last_used_at = ? WHERE id = ?",
+                               (time.time(), self._ids[best]))
+            self._conn.commit()
+        return {
+            "question": row[0],
+            "answer": row[1],
+            "context": [Document(**source) for source in json.loads(row[2])],
+            "similarity": similarity,
+            "pinned": bool(row[4]),
+        }
+
+    # Whether the exact question already has a pinned answer in this namespace
+    def is_pinned(self, question, namespace):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM answers WHERE namespace = ? AND question = ? AND pinned = 1",
+                (namespace, question)).fetchone()
+        return row is not None
+
+    def store(self, question, answer, documents, namespace, pinned=False):
+        vector = _normalize(self.embeddings.embed_query(question))
+        sources = json.dumps([{"page_content": doc.page_content, "metadata": doc.metadata}
+                              for doc in documents])
+        now = time.time()
+        with self._lock:
+            # entries from an older prompt or corpus can never be served again
+            self._conn.execute("DELETE FROM answers WHERE namespace != ? OR (pinned = 0 AND created_at < ?)",
+                               (namespace, now - self.ttl_seconds))
+            if pinned:
+                # re-pinning a question replaces its previous answer
+                self._conn.execute("DELETE FROM answers WHERE namespace = ? AND question = ? AND pinned = 1",
+                                   (namespace, question))
+            self._conn.execute(
+                "INSERT INTO answers (namespace, question, embedding, answer, sources, created_at, last_used_at, pinned) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (namespace, question, vector.tobytes(), answer, sources, now, now, int(pinned)))
+            self._conn.execute(
+                "DELETE FROM answers WHERE pinned = 0 AND id NOT IN "
+                "(SELECT id FROM answers WHERE pinned = 0 ORDER BY last_used_at DESC LIMIT ?)",
+                (self.max_entries,))
+            self._conn.commit()
+            self._load(namespace)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+            self._namespace = None
+            self._ids = []
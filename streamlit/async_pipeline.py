@@ -0,0 +1,132 @@
+import asyncio
+import queue
+import threading
+import weakref
+from langchain_openai import ChatOpenAI
+from rate_limiter import DEFAULT_OUTPUT_TOKENS, get_scheduler
+from settings import get_setting
+
+# Default cap on LLM calls in flight across the whole process
+DEFAULT_MAX_INFLIGHT_LLM_CALLS = 8
+
+# Tokens the chat format adds to every message
+TOKENS_PER_MESSAGE = 4
+
+_semaphores = weakref.WeakKeyDictionary()
+_semaphores_lock = threading.Lock()
+
+
+# One semaphore per event loop (asyncio primitives can't be shared across loops).
+# In the app every call runs on the single loop owned by EventLoopThread.
+def llm_semaphore():
+    loop = asyncio.get_running_loop()
+    with _semaphores_lock:
+        semaphore = _semaphores.get(loop)
+        if semaphore is None:
+            limit = int(get_setting("MAX_INFLIGHT_LLM_CALLS", DEFAULT_MAX_INFLIGHT_LLM_CALLS))
+            semaphore = _semaphores[loop] = asyncio.Semaphore(limit)
+        return semaphore
+
+
+def _result_tokens(result):
+    usage = (result.llm_output or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+
+def _chunk_tokens(chunk):
+    usage = getattr(chunk.message, "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+
+# ChatOpenAI whose calls are admitted by the process-wide rate limit scheduler (at the
+# priority of the caller's rate_limiter.priority_scope), and whose async calls also
+# wait for a slot in the process-wide semaphore, so a burst of sessions queues up
+# instead of opening unbounded concurrent requests. The scheduler retries 429s, so
+# create_llm turns off the client's own retries.
+class ThrottledChatOpenAI(ChatOpenAI):
+    def _estimate_tokens(self, scheduler, messages):
+        return scheduler.estimate([str(message.content) for message in messages], self.model_name,
+                                  TOKENS_PER_MESSAGE * len(messages) + (self.max_tokens or DEFAULT_OUTPUT_TOKENS))
+
+    def _generate(self, messages, *args, **kwargs):
+        scheduler = get_scheduler()
+        estimated = self._estimate_tokens(scheduler, messages)
+        generate = super()._generate
+        result = scheduler.run(lambda: generate(messages, *args, **kwargs), estimated)
+        scheduler.settle(estimated, _result_tokens(result))
+        return result
+
+    def _stream(self, messages, *args, **kwargs):
+        scheduler = get_scheduler()
+        estimated = self._estimate_tokens(scheduler, messages)
+        stream = super()._stream
+        used = None
+        for chunk in scheduler.stream(lambda: stream(messages, *args, **kwargs), estimated):
+            used = _chunk_tokens(chunk) or used
+            yield chunk
+        scheduler.settle(estimated, used)
+
+    async def _agenerate(self, messages, *args, **kwargs):
+        scheduler = get_scheduler()
+        estimated = self._estimate_tokens(scheduler, messages)
+        agenerate = super()._agenerate
+        async with llm_semaphore():
+            result = await scheduler.arun(lambda: agenerate(messages, *args, **kwargs), estimated)
+        await scheduler.asettle(estimated, _result_tokens(result))
+        return result
+
+    async def _astream(self, messages, *args, **kwargs):
+        scheduler = get_scheduler()
+        estimated = self._estimate_tokens(scheduler, messages)
+        astream = super()._astream
+        used = None
+        async with llm_semaphore():
+            async for chunk in scheduler.astream(lambda: astream(messages, *args, **kwargs), estimated):
+                used = _chunk_tokens(chunk) or used
+                yield chunk
+        await scheduler.asettle(estimated, used)
+
+
+# A dedicated asyncio loop running in a daemon thread. Streamlit script threads hand
+# coroutines to it and wait on the result (or on a queue of streamed chunks), so the
+# rephrase, retrieval and generation I/O all run on one loop with pooled async clients.
+class EventLoopThread:
+    def __init__(self, name="lease-assistant-loop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    # Run a coroutine on the loop and block until it finishes
+    def run(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    # Iterate an async iterator on the loop and yield its items in the calling thread
+    def stream(self, async_iterator):
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in async_iterator:
+                    items.put((item, None))
+            except BaseException as error:
+                items.put((done, error))
+                raise
+            else:
+                items.put((done, None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item, error = items.get()
+                if item is done:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            # the caller stopped early (or failed); stop the producer too
+            future.cancel()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
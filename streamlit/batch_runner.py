@@ -0,0 +1,141 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from lease_chain import build_headless_chain
+from rate_limiter import BATCH, priority_scope
+from telemetry import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Headless question answering for month-end FAQ runs:
+#
+#   python streamlit/batch_runner.py questions.csv answers.jsonl --workers 8
+#
+# Questions come from a CSV with a "question" column (and optional "id" column) or a
+# jsonl file of {"id": ..., "question": ...}. Answers are appended to the output jsonl
+# as they finish, so an interrupted run picks up where it stopped.
+
+# Questions embedded per request when pre-warming the embedding cache
+EMBEDDING_BATCH_SIZE = 256
+
+
+def question_id(question):
+    return hashlib.sha256(question.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def read_questions(path):
+    questions = []
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as questions_file:
+            rows = [json.loads(line) for line in questions_file if line.strip()]
+    else:
+        with open(path, newline="", encoding="utf-8") as questions_file:
+            rows = list(csv.DictReader(questions_file))
+    seen = set()
+    for row in rows:
+        question = (row.get("question") or "").strip()
+        if not question:
+            continue
+        item_id = str(row.get("id") or question_id(question))
+        # one result line per id, so resuming can tell what is done
+        if item_id in seen:
+            logger.warning("Skipping duplicate question id %s", item_id)
+            continue
+        seen.add(item_id)
+        questions.append({"id": item_id, "question": question})
+    return questions
+
+
+# Ids that already have an answer in the output file
+def completed_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as results_file:
+        for line in results_file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by an interrupted run
+                continue
+            if result.get("answer") is not None:
+                done.add(result["id"])
+    return done
+
+
+def source_metadata(documents):
+    return [{"metadata": doc.metadata, "excerpt": doc.page_content[:300]} for doc in documents]
+
+
+# Answer one question. Rate limits and transient API errors are retried by the
+# rate_limiter scheduler underneath the chain; anything that still fails is recorded
+# and retried by re-running the batch.
+def answer_question(chain, item):
+    start = time.perf_counter()
+    try:
+        response = chain.invoke({"input": item["question"], "chat_history": []})
+    except Exception as error:
+        logger.warning("Question %s failed: %s", item["id"], error)
+        return {"id": item["id"], "question": item["question"], "answer": None, "error": str(error)}
+    return {"id": item["id"],
+            "question": item["question"],
+            "answer": response["answer"],
+            "sources": source_metadata(response["context"]),
+            "seconds": round(time.perf_counter() - start, 2)}
+
+
+# Embed every question up front in large batches. Retrieval then finds the question
+# vectors in the embedding cache instead of making one embeddings call per question.
+def prewarm_embeddings(embeddings, questions):
+    texts = [item["question"] for item in questions]
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        embeddings.embed_documents(texts[start:start + EMBEDDING_BATCH_SIZE])
+
+
+def run_batch(questions_path, output_path, workers=4):
+    questions = read_questions(questions_path)
+    done = completed_ids(output_path)
+    pending = [item for item in questions if item["id"] not in done]
+    logger.info("%s questions, %s already answered, %s to run", len(questions), len(done), len(pending))
+    if not pending:
+        return
+
+    chain, embeddings, _ = build_headless_chain()
+    # batch calls yield the rate limit to interactive questions
+    with priority_scope(BATCH):
+        prewarm_embeddings(embeddings, pending)
+
+    write_lock = threading.Lock()
+    with open(output_path, "a", encoding="utf-8") as results_file:
+        def run_one(item):
+            with priority_scope(BATCH):
+                result = answer_question(chain, item)
+            with write_lock:
+                results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+            return result
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            failures = sum(1 for result in executor.map(run_one, pending) if result["answer"] is None)
+    logger.info("Finished: %s answered, %s failed (re-run to retry them)", len(pending) - failures, failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a list of questions with the lease assistant.")
+    parser.add_argument("questions", help="CSV (question[,id] columns) or jsonl input")
+    parser.add_argument("output", help="jsonl file to append results to")
+    parser.add_argument("--workers", type=int, default=4, help="questions answered concurrently")
+    args = parser.parse_args()
+
+    configure_logging()
+    run_batch(args.questions, args.output, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from langchain_community.vectorstores import Qdrant
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from qdrant_client import QdrantClient, models
+from embedding_cache import CachedEmbeddings
+from guidance_filters import chunk_party, chunk_topics
+from lease_chain import (EMBEDDING_MODEL, build_retrieval_chain, create_retriever, setup_prompt_template,
+                         trim_history)
+from lexical_index import LexicalIndex
+from telemetry import StageCallbackHandler
+
+# Offline benchmark of the Submit path. The real chain from lease_chain.py runs
+# against deterministic stand-ins for OpenAI and an in-memory Qdrant, so it needs no
+# API keys (without network, tokens are counted approximately; see get_encoding):
+#
+#   python streamlit/benchmark.py --pages 1000 --sessions 8 --questions 5
+
+COLLECTION_NAME = "benchmark"
+
+TOPICS = ["lease components", "nonlease components", "lease term", "discount rate",
+          "right-of-use asset", "lease liability", "sales-type lease", "operating lease",
+          "finance lease", "lease modification", "sale and leaseback", "variable payments",
+          "initial direct costs", "lease incentives", "short-term lease exemption",
+          "embedded leases", "subleases", "impairment of the ROU asset"]
+PARTIES = ["lessee", "lessor", "lessee and lessor"]
+
+QUESTIONS = [
+    "What are lease components and nonlease components, and how are they identified?",
+    "What are the journal entries required to account for a lease for lessees and lessors?",
+    "What are the steps required in considering a lease modification?",
+    "I don't understand what a sales-type lease is, can you help me understand and explain it like I'm a child?",
+    "How does a lessee determine the discount rate under 842-20-30-3?",
+    "When is a sale and leaseback accounted for as a failed sale?",
+]
+FOLLOW_UPS = ["What about for lessors?", "Can you give an example?", "How is that presented?"]
+
+
+# Synthetic handbook: a few chunks per page of lease-accounting sounding text with
+# codification references, shaped like the payloads ingest.py writes
+def synthetic_corpus(pages, chunks_per_page=4, seed=7):
+    rng = random.Random(seed)
+    documents = []
+    for page in range(pages):
+        for _ in range(chunks_per_page):
+            topic = rng.choice(TOPICS)
+            party = rng.choice(PARTIES)
+            citation = f"842-{rng.choice([10, 20, 30, 40, 50])}-{rng.choice([15, 25, 30, 35, 45, 55])}-{rng.randint(1, 40)}"
+            sentences = [
+                f"Under ASC {citation}, the {party} evaluates the {topic} at lease commencement.",
+                f"The {party} considers whether the {topic} affects the measurement of the lease liability.",
+                f"KPMG observation: entities often apply judgment when assessing the {rng.choice(TOPICS)}.",
+                f"Example {rng.randint(1, 99)}: a {party} enters into a lease of equipment with {rng.choice(TOPICS)}.",
+            ]
+            rng.shuffle(sentences)
+            text = " ".join(sentences * 3)
+            # same payload fields as ingest.py attaches, for the filtered search
+            documents.append((text, {"source": "synthetic-handbook.pdf", "page": page,
+                                     "party": chunk_party(text.lower()),
+                                     "topic": chunk_topics(text.lower())}))
+    return documents
+
+
+def seed_qdrant(client, embeddings, corpus):
+    vector_size = len(embeddings.embed_query("size probe"))
+    client.create_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE),
+    )
+    vectors = embeddings.embed_documents([text for text, _ in corpus])
+    points = [models.PointStruct(id=str(uuid.uuid4()),
+                                 vector=vector,
+                                 payload={"page_content": text, "metadata": metadata})
+              for (text, metadata), vector in zip(corpus, vectors)]
+    for start in range(0, len(points), 512):
+        client.upsert(collection_name=COLLECTION_NAME, points=points[start:start + 512])
+
+
+# Deterministic embeddings with a simulated round trip
+class FakeEmbeddings(Embeddings):
+    def __init__(self, size, latency):
+        self.base = DeterministicFakeEmbedding(size=size)
+        self.latency = latency
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self.base.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        return self.base.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self.base.embed_query(text)
+
+
+# Chat model that streams a canned answer with a simulated time to first token and
+# per-token delay
+class FakeChatModel(BaseChatModel):
+    answer: str = " ".join(["The lessee recognizes a right-of-use asset and a lease liability."] * 20)
+    first_token_latency: float = 0.2
+    token_latency: float = 0.002
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark-chat"
+
+    def _tokens(self):
+        return [word + " " for word in self.answer.split(" ")]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_latency + self.token_latency * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_latency)
+        for token in self._tokens():
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_latency + self.token_latency * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._tokens():
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+# Keeps every stage duration so the report can give exact percentiles
+class StageTimer(StageCallbackHandler):
+    def __init__(self):
+        super().__init__()
+        self.durations = defaultdict(list)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.durations[stage].append(seconds)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# One simulated session: a standalone question followed by follow-ups that carry history
+def session_questions(session, count):
+    questions = [QUESTIONS[session % len(QUESTIONS)]]
+    questions += [FOLLOW_UPS[i % len(FOLLOW_UPS)] for i in range(count - 1)]
+    return questions
+
+
+def run_session_sync(chain, session, count, timer, results):
+    history = []
+    for question in session_questions(session, count):
+        start = time.perf_counter()
+        first_token = None
+        answer = ""
+        inputs = {"input": question, "chat_history": trim_history(history)}
+        for chunk in chain.stream(inputs, config={"callbacks": [timer]}):
+            if "answer" in chunk:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                answer += chunk["answer"]
+        results["total"].append(time.perf_counter() - start)
+        results["first_token"].append(first_token or 0.0)
+        history.append((question, answer))
+
+
+async def run_session_async(chain, session, count, timer, results):
+    history = []
+    for question in session_questions(session, count):
+        start = time.perf_counter()
+        first_token = None
+        answer = ""
+        inputs = {"input": question, "chat_history": trim_history(history)}
+        async for chunk in chain.astream(inputs, config={"callbacks": [timer]}):
+            if "answer" in chunk:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                answer += chunk["answer"]
+        results["total"].append(time.perf_counter() - start)
+        results["first_token"].append(first_token or 0.0)
+        history.append((question, answer))
+
+
+def run_benchmark(args):
+    # tracing every allocation slows the run down, so it is opt-in
+    if args.trace_memory:
+        tracemalloc.start()
+    seed_start = time.perf_counter()
+    corpus = synthetic_corpus(args.pages, args.chunks_per_page)
+    client = QdrantClient(":memory:")
+    seed_qdrant(client, DeterministicFakeEmbedding(size=args.dimensions), corpus)
+    seed_seconds = time.perf_counter() - seed_start
+
+    embeddings = FakeEmbeddings(args.dimensions, args.embedding_latency)
+    if not args.no_embedding_cache:
+        embeddings = CachedEmbeddings(embeddings, EMBEDDING_MODEL)
+    vector_store = Qdrant(client=client, collection_name=COLLECTION_NAME, embeddings=embeddings)
+    lexical_index = None
+    if not args.no_lexical:
+        lexical_index = LexicalIndex(Document(page_content=text, metadata=metadata)
+                                     for text, metadata in corpus)
+    llm = FakeChatModel(first_token_latency=args.llm_latency, token_latency=args.token_latency)
+    # filtered search is chosen explicitly: the in-memory store has no payload indexes,
+    # so the FILTERED_SEARCH=auto default would turn it off
+    retriever = create_retriever(vector_store, lexical_index, filtered=not args.no_filters)
+    chain = build_retrieval_chain(vector_store, llm=llm, prompt_template=setup_prompt_template(),
+                                  lexical_index=lexical_index, retriever=retriever)
+
+    timer = StageTimer()
+    results = defaultdict(list)
+    start = time.perf_counter()
+    if args.mode == "async":
+        async def run_all():
+            await asyncio.gather(*(run_session_async(chain, session, args.questions, timer, results)
+                                   for session in range(args.sessions)))
+        asyncio.run(run_all())
+    else:
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            futures = [executor.submit(run_session_sync, chain, session, args.questions, timer, results)
+                       for session in range(args.sessions)]
+            for future in futures:
+                future.result()
+    elapsed = time.perf_counter() - start
+    peak_traced = None
+    if args.trace_memory:
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    report = {
+        "mode": args.mode,
+        "sessions": args.sessions,
+        "questions": len(results["total"]),
+        "corpus_points": len(corpus),
+        "seed_seconds": round(seed_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_qps": round(len(results["total"]) / elapsed, 3) if elapsed else 0.0,
+        "peak_traced_mb": round(peak_traced / 1e6, 1) if peak_traced is not None else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": {},
+    }
+    for stage, values in [*timer.durations.items(), ("first_token", results["first_token"]),
+                          ("end_to_end", results["total"])]:
+        report["stages"][stage] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+        }
+    if isinstance(embeddings, CachedEmbeddings):
+        report["embedding_cache"] = embeddings.stats()
+    return report
+
+
+def print_report(report):
+    print(f"{report['questions']} questions, {report['sessions']} concurrent sessions ({report['mode']}), "
+          f"{report['corpus_points']} points")
+    print(f"throughput: {report['throughput_qps']} questions/s over {report['elapsed_seconds']}s")
+    if report["peak_traced_mb"] is not None:
+        print(f"peak traced memory: {report['peak_traced_mb']} MB (latencies include tracing overhead)")
+    print(f"max RSS: {report['max_rss_mb']} MB")
+    print(f"{'stage':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'mean ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<14}{stats['count']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['mean_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency/load benchmark of the retrieval chain.")
+    parser.add_argument("--pages", type=int, default=1000, help="synthetic handbook pages")
+    parser.add_argument("--chunks-per-page", type=int, default=4)
+    parser.add_argument("--dimensions", type=int, default=3072, help="embedding size")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent simulated sessions")
+    parser.add_argument("--questions", type=int, default=3, help="questions per session")
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings call")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds to first token")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="seconds per streamed token")
+    parser.add_argument("--no-lexical", action="store_true", help="dense-only retrieval")
+    parser.add_argument("--no-filters", action="store_true", help="skip the metadata-filtered search")
+    parser.add_argument("--no-embedding-cache", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report peak Python heap with tracemalloc (slows the run)")
+    parser.add_argument("--json", default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
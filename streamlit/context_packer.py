@@ -0,0 +1,91 @@
+import re
+from langchain_core.documents import Document
+
+# Default token budget for the retrieved guidance stuffed into {context}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+
+# Overlaps shorter than this are treated as coincidence rather than splitter overlap
+MIN_OVERLAP_CHARS = 40
+# The splitter overlap is 200 characters; leave some headroom
+MAX_OVERLAP_CHARS = 400
+
+
+# Stand-in for a tiktoken encoding when its vocabulary can't be downloaded: roughly
+# one token per word or punctuation mark, and decode(encode(text)) gives the text back
+class ApproximateEncoding:
+    pattern = re.compile(r"\s*\w+|\s*[^\w\s]|\s+")
+
+    def encode(self, text):
+        return self.pattern.findall(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+# Length of the longest suffix of `first` that is also a prefix of `second`
+def overlap_length(first, second):
+    longest = min(len(first), len(second), MAX_OVERLAP_CHARS)
+    for length in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def _score(doc):
+    return doc.metadata.get("score", 0.0)
+
+
+# Metadata for a merged chunk: that of the chunk whose text comes first (so sources
+# and page links point where the merged text starts), keeping the higher score of `kept`
+def _leading_metadata(first, kept):
+    if first is kept or "score" not in kept.metadata:
+        return first.metadata
+    return {**first.metadata, "score": kept.metadata["score"]}
+
+
+# Merge `doc` into `kept` if one contains the other or they are neighbouring chunks
+# that share the splitter overlap. Returns the merged document, or None.
+def _merge(kept, doc):
+    if doc.page_content in kept.page_content:
+        return kept
+    if kept.page_content in doc.page_content:
+        first = kept if doc.page_content.startswith(kept.page_content) else doc
+        return Document(page_content=doc.page_content, metadata=_leading_metadata(first, kept))
+    if kept.metadata.get("source") != doc.metadata.get("source"):
+        return None
+    length = overlap_length(kept.page_content, doc.page_content)
+    if length:
+        return Document(page_content=kept.page_content + doc.page_content[length:], metadata=kept.metadata)
+    length = overlap_length(doc.page_content, kept.page_content)
+    if length:
+        return Document(page_content=doc.page_content + kept.page_content[length:],
+                        metadata=_leading_metadata(doc, kept))
+    return None
+
+
+# Dedupe overlapping chunks, order them by score (retriever order breaks ties) and
+# keep as many as fit in `max_tokens`
+def pack_documents(documents, encoding, max_tokens=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    ordered = sorted(documents, key=_score, reverse=True)
+    kept = []
+    for doc in ordered:
+        for position, existing in enumerate(kept):
+            merged = _merge(existing, doc)
+            if merged is not None:
+                kept[position] = merged
+                break
+        else:
+            kept.append(doc)
+
+    packed = []
+    used = 0
+    for doc in kept:
+        tokens = encoding.encode(doc.page_content)
+        if used + len(tokens) <= max_tokens:
+            packed.append(doc)
+            used += len(tokens)
+        elif not packed:
+            # always send something: cut the best chunk down to the budget
+            packed.append(Document(page_content=encoding.decode(tokens[:max_tokens]), metadata=doc.metadata))
+            used = max_tokens
+    return packed
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from lexical_index import citations_in, reciprocal_rank_fusion
+from settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Default location of the per-collection centroids
+DEFAULT_CENTROIDS_PATH = ".cache/corpus_centroids.json"
+
+# Collections searched per question
+DEFAULT_TOP_N = 2
+
+# A corpus is searched only if its centroid score is within this fraction of the best one
+DEFAULT_MARGIN = 0.1
+
+
+# Registry of searchable corpora, as {name: collection}. Set CORPORA in secrets.toml
+# as a table (or in the environment as a json object); without it the registry is
+# just the lease handbook collection.
+def get_corpus_registry(default_collection):
+    corpora = get_setting("CORPORA")
+    if not corpora:
+        return {"leases": default_collection}
+    if isinstance(corpora, str):
+        corpora = json.loads(corpora)
+    return {str(name): str(collection) for name, collection in dict(corpora).items()}
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# Mean direction of every vector in a collection. One pass over the stored vectors;
+# run at ingestion time, not per question.
+def compute_centroid(client, collection_name):
+    total = None
+    count = 0
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name,
+                                       with_payload=False,
+                                       with_vectors=True,
+                                       limit=1000,
+                                       offset=offset)
+        if points:
+            vectors = _normalize(np.asarray([point.vector for point in points], dtype=np.float32))
+            total = vectors.sum(axis=0) if total is None else total + vectors.sum(axis=0)
+            count += len(points)
+        if offset is None:
+            break
+    if total is None:
+        return None, 0
+    return _normalize(total / count), count
+
+
+def load_centroids(path=DEFAULT_CENTROIDS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as centroids_file:
+        return json.load(centroids_file)
+
+
+def save_centroids(centroids, path=DEFAULT_CENTROIDS_PATH):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as centroids_file:
+        json.dump(centroids, centroids_file)
+
+
+# Recompute the centroid of every collection whose point count changed since the
+# centroids were last written (or all of them with force=True)
+def refresh_centroids(client, collections, path=DEFAULT_CENTROIDS_PATH, force=False):
+    centroids = load_centroids(path)
+    changed = False
+    for collection in collections:
+        points = client.count(collection_name=collection, exact=True).count
+        stored = centroids.get(collection)
+        if not force and stored and stored["points"] == points:
+            continue
+        centroid, points = compute_centroid(client, collection)
+        if centroid is None:
+            centroids.pop(collection, None)
+        else:
+            centroids[collection] = {"points": points, "centroid": centroid.tolist()}
+        changed = True
+        logger.info("Centroid for %s recomputed over %s points", collection, points)
+    if changed:
+        save_centroids(centroids, path)
+    return centroids
+
+
+# Routes a question to the corpora whose centroid is closest to the question
+# embedding and runs those corpora's retrievers concurrently. Each corpus keeps its own
+# retriever (for the lease handbook, the BM25 hybrid with the lessee/lessor filters),
+# so registering another corpus doesn't change how the handbook is searched.
+#
+# Only corpora scoring within `margin` (relative) of the best centroid score are
+# searched. The per-corpus rankings aren't on a common score scale, so they are merged
+# with reciprocal rank fusion, each list weighted by how close its corpus scored to the
+# best one: the best corpus gets weight 1 and a corpus right at the margin gets 0, so a
+# distant corpus only fills in behind the best one's top hits instead of alternating
+# with them. Questions citing a codification reference go straight to
+# `citation_corpus`, without the routing embedding.
+class CorpusRouter(BaseRetriever):
+    # {corpus name: retriever}
+    retrievers: Any
+    # {corpus name: normalized centroid}; corpora without one are always searched
+    centroids: Any
+    embeddings: Any
+    citation_corpus: Optional[str] = None
+    k: int = 4
+    top_n: int = DEFAULT_TOP_N
+    margin: float = DEFAULT_MARGIN
+    rrf_k: int = 60
+
+    # [(corpus name, fusion weight)] for the corpora to search
+    def route(self, vector):
+        routed = [(name, 1.0) for name in self.retrievers if name not in self.centroids]
+        scored = sorted(((float(np.dot(self.centroids[name], vector)), name)
+                         for name in self.retrievers if name in self.centroids), reverse=True)
+        if scored:
+            best = scored[0][0]
+            floor = best - abs(best) * self.margin
+            for score, name in scored[:self.top_n]:
+                if score < floor:
+                    break
+                weight = (score - floor) / (best - floor) if best > floor else 1.0
+                routed.append((name, weight))
+        return routed
+
+    def _cited(self, query):
+        return self.citation_corpus in self.retrievers and bool(citations_in(query))
+
+    # The question embedding is cached, so the retrievers reuse it for their own searches
+    def _query_vector(self, query):
+        return _normalize(np.asarray(self.embeddings.embed_query(query), dtype=np.float32))
+
+    async def _aquery_vector(self, query):
+        return _normalize(np.asarray(await self.embeddings.aembed_query(query), dtype=np.float32))
+
+    def _merge(self, routed, results):
+        ranked = [[Document(page_content=doc.page_content, metadata={**doc.metadata, "corpus": name})
+                   for doc in documents] for (name, _), documents in zip(routed, results)]
+        if len(ranked) == 1:
+            return ranked[0][:self.k]
+        return reciprocal_rank_fusion(ranked, self.rrf_k, [weight for _, weight in routed])[:self.k]
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        if self._cited(query):
+            routed = [(self.citation_corpus, 1.0)]
+        else:
+            routed = self.route(self._query_vector(query))
+
+        def search(route):
+            return self.retrievers[route[0]].invoke(query)
+
+        with ThreadPoolExecutor(max_workers=len(routed) or 1) as executor:
+            results = list(executor.map(search, routed))
+        return self._merge(routed, results)
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        if self._cited(query):
+            routed = [(self.citation_corpus, 1.0)]
+        else:
+            routed = self.route(await self._aquery_vector(query))
+        results = await asyncio.gather(*(self.retrievers[name].ainvoke(query) for name, _ in routed))
+        return self._merge(routed, results)
+
+
+def main():
+    from lease_chain import create_qdrant_client, get_collection_name
+
+    parser = argparse.ArgumentParser(description="Recompute the per-collection centroids used for routing.")
+    parser.add_argument("--force", action="store_true", help="recompute even if the point count is unchanged")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    registry = get_corpus_registry(get_collection_name())
+    refresh_centroids(create_qdrant_client(), list(registry.values()),
+                      path=get_setting("CORPUS_CENTROIDS_PATH", DEFAULT_CENTROIDS_PATH),
+                      force=args.force)
+
+
+if __name__ == "__main__":
+    main()
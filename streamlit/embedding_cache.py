@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from telemetry import metrics, span
+
+# Defaults for the embedding cache (override with the EMBEDDING_CACHE_* settings)
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_DISK_PATH = ".cache/embedding_cache.sqlite3"
+
+
+# Whitespace differences don't change what the user asked
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def cache_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# Memoizing wrapper around an Embeddings instance. Vectors are kept as float32 arrays
+# in an in-memory LRU, backed by an optional SQLite file so they survive restarts.
+# The hit/miss counters are available from stats(). With a rate_limiter scheduler,
+# the calls for cache misses are admitted (and retried) by it.
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, model_name, max_entries=DEFAULT_MAX_ENTRIES, disk_path=None, scheduler=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.scheduler = scheduler
+        self.max_entries = int(max_entries)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn = None
+        if disk_path:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(disk_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._conn.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # Look a key up in memory, then on disk. Must be called with the lock held.
+    def _get(self, key):
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return vector
+        if self._conn is not None:
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                vector = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+        return None
+
+    def _put_many(self, items):
+        if not items:
+            return
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, vector)
+            if self._conn is not None:
+                self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                       [(key, vector.tobytes()) for key, vector in items])
+                self._conn.commit()
+
+    # Split texts into cached vectors and the positions that still need embedding
+    def _lookup_many(self, texts):
+        keys = [cache_key(self.model_name, text) for text in texts]
+        vectors = [None] * len(texts)
+        missing = []
+        with self._lock:
+            for index, key in enumerate(keys):
+                vectors[index] = self._get(key)
+                if vectors[index] is None:
+                    missing.append(index)
+            self.misses += len(missing)
+        metrics.increment("lease_assistant_cache_total", {"cache": "embedding", "result": "hit"},
+                          len(texts) - len(missing))
+        metrics.increment("lease_assistant_cache_total", {"cache": "embedding", "result": "miss"},
+                          len(missing))
+        return keys, vectors, missing
+
+    def _fill_missing(self, keys, vectors, missing, fresh):
+        items = []
+        for index, vector in zip(missing, fresh):
+            vectors[index] = np.asarray(vector, dtype=np.float32)
+            items.append((keys[index], vectors[index]))
+        self._put_many(items)
+        return [vector.tolist() for vector in vectors]
+
+    # Call the wrapped embeddings for the misses, through the scheduler if there is one
+    def _call(self, call, texts):
+        if self.scheduler is None:
+            return call()
+        return self.scheduler.run(call, self.scheduler.estimate(texts, self.model_name))
+
+    # Run a cache read or write for the async methods. With the SQLite file behind the
+    # cache it goes to a worker thread, so disk I/O (and waiting for the lock while a
+    # sync caller is on disk) doesn't stall the event loop.
+    async def _off_loop(self, function, *args):
+        if self._conn is None:
+            return function(*args)
+        return await asyncio.to_thread(function, *args)
+
+    async def _acall(self, call, texts):
+        if self.scheduler is None:
+            return await call()
+        return await self.scheduler.arun(call, self.scheduler.estimate(texts, self.model_name))
+
+    def embed_documents(self, texts):
+        keys, vectors, missing = self._lookup_many(texts)
+        fresh = []
+        if missing:
+            # embed all the misses in one request
+            with span("embedding"):
+                pending = [texts[index] for index in missing]
+                fresh = self._call(lambda: self.embeddings.embed_documents(pending), pending)
+        return self._fill_missing(keys, vectors, missing, fresh)
+
+    async def aembed_documents(self, texts):
+        keys, vectors, missing = await self._off_loop(self._lookup_many, texts)
+        fresh = []
+        if missing:
+            with span("embedding"):
+                pending = [texts[index] for index in missing]
+                fresh = await self._acall(lambda: self.embeddings.aembed_documents(pending), pending)
+        return await self._off_loop(self._fill_missing, keys, vectors, missing, fresh)
+
+    def embed_query(self, text):
+        keys, vectors, missing = self._lookup_many([text])
+        fresh = []
+        if missing:
+            with span("embedding"):
+                fresh = [self._call(lambda: self.embeddings.embed_query(text), [text])]
+        return self._fill_missing(keys, vectors, missing, fresh)[0]
+
+    async def aembed_query(self, text):
+        keys, vectors, missing = await self._off_loop(self._lookup_many, [text])
+        fresh = []
+        if missing:
+            with span("embedding"):
+                fresh = [await self._acall(lambda: self.embeddings.aembed_query(text), [text])]
+        return (await self._off_loop(self._fill_missing, keys, vectors, missing, fresh))[0]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "entries": len(self._memory)}
@@ -0,0 +1,185 @@
+import re
+from typing import Any
+from langchain_community.vectorstores import Qdrant
+from langchain_core.retrievers import BaseRetriever
+from qdrant_client import models
+from local_store import NumpyVectorStore
+from telemetry import metrics, span
+
+# Structured payload fields attached to every chunk at ingestion and indexed in Qdrant
+FILTER_FIELDS = ("chapter", "section", "party", "topic")
+
+# Chunks retrieved when the question was narrowed by a filter (4 otherwise)
+DEFAULT_FILTERED_K = 3
+
+# Terms that only apply to one side of the lease
+PARTY_TERMS = {
+    "lessee": ("lessee", "right-of-use", "rou asset", "lease liability", "lease liabilities"),
+    "lessor": ("lessor", "sales-type", "direct financing", "net investment in the lease", "selling profit"),
+}
+
+# Topic vocabulary shared by the chunk tagger and the query classifier
+TOPIC_TERMS = {
+    "scope": ("identified asset", "contains a lease", "definition of a lease", "right to control"),
+    "components": ("lease component", "nonlease component", "non-lease component"),
+    "lease_term": ("lease term", "renewal option", "termination option", "purchase option"),
+    "lease_payments": ("lease payments", "variable lease payment", "variable payment", "residual value guarantee"),
+    "discount_rate": ("discount rate", "incremental borrowing rate", "rate implicit"),
+    "classification": ("classification", "classify", "classified", "sales-type", "direct financing"),
+    "initial_direct_costs": ("initial direct cost",),
+    "modifications": ("modification", "modified lease"),
+    "remeasurement": ("remeasure",),
+    "sale_leaseback": ("sale-leaseback", "sale and leaseback", "leaseback"),
+    "subleases": ("sublease",),
+    "impairment": ("impairment", "impaired"),
+    "journal_entries": ("journal entr",),
+    "presentation_disclosure": ("presentation", "disclosure", "disclose"),
+    "transition": ("transition", "adoption of topic 842"),
+    "short_term": ("short-term lease",),
+    "business_combinations": ("business combination",),
+    "leveraged_leases": ("leveraged lease",),
+}
+
+# Numbered handbook headings such as "5.2 Initial measurement"
+SECTION_HEADING = re.compile(r"^\s*(\d{1,2})\.(\d{1,2})\s+[A-Z][A-Za-z]", re.MULTILINE)
+CHAPTER_REFERENCE = re.compile(r"\bchapter\s+(\d{1,2})\b", re.IGNORECASE)
+SECTION_REFERENCE = re.compile(r"\bsection\s+(\d{1,2})\.(\d{1,2})\b", re.IGNORECASE)
+
+
+def _matches(text, terms):
+    return sum(text.count(term) for term in terms)
+
+
+# Runs in the ingestion process over the page stream, in page order: every page is
+# tagged with the last chapter/section heading seen on it or on an earlier page
+def annotate_pages(pages):
+    chapter = section = None
+    for page in pages:
+        headings = SECTION_HEADING.findall(page.page_content)
+        if headings:
+            chapter, minor = headings[0]
+            section = f"{chapter}.{minor}"
+        if chapter is not None:
+            page.metadata["chapter"] = chapter
+            page.metadata["section"] = section
+        yield page
+        if headings:
+            # the page continues under its last heading
+            chapter, minor = headings[-1]
+            section = f"{chapter}.{minor}"
+
+
+def chunk_party(text):
+    lessee = _matches(text, PARTY_TERMS["lessee"])
+    lessor = _matches(text, PARTY_TERMS["lessor"])
+    if lessee > 2 * lessor:
+        return "lessee"
+    if lessor > 2 * lessee:
+        return "lessor"
+    # guidance that applies to both sides, or to neither in particular
+    return "both"
+
+
+def chunk_topics(text):
+    return sorted(topic for topic, terms in TOPIC_TERMS.items() if _matches(text, terms))
+
+
+# Runs in the splitter worker processes: party and topic payload fields for one chunk
+def tag_chunk(chunk):
+    text = chunk.page_content.lower()
+    chunk.metadata["party"] = chunk_party(text)
+    chunk.metadata["topic"] = chunk_topics(text)
+    return chunk
+
+
+# Cheap keyword classifier: pick a metadata filter for the question, as
+# {field: [allowed values]}. Empty when nothing in the question narrows the search.
+def classify_query(question):
+    text = question.lower()
+    conditions = {}
+    parties = [party for party, terms in PARTY_TERMS.items() if _matches(text, terms)]
+    if len(parties) == 1:
+        conditions["party"] = [parties[0], "both"]
+    topics = chunk_topics(text)
+    if 0 < len(topics) <= 3:
+        conditions["topic"] = topics
+    section = SECTION_REFERENCE.search(question)
+    chapter = CHAPTER_REFERENCE.search(question)
+    if section:
+        conditions["section"] = [f"{section.group(1)}.{section.group(2)}"]
+    elif chapter:
+        conditions["chapter"] = [chapter.group(1)]
+    return conditions
+
+
+# Whether chunk metadata passes a filter; list-valued fields (topic) match on any value
+def metadata_matches(metadata, conditions):
+    for field, allowed in conditions.items():
+        value = metadata.get(field)
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if not any(item in allowed for item in values):
+            return False
+    return True
+
+
+def to_qdrant_filter(conditions):
+    return models.Filter(must=[
+        models.FieldCondition(key=f"metadata.{field}", match=models.MatchAny(any=list(allowed)))
+        for field, allowed in conditions.items()
+    ])
+
+
+# Whether a Qdrant collection has the payload indexes ingest.py creates for the filter
+# fields. A collection built without them has no such payload, so every filtered
+# search over it would come back empty and be repeated unfiltered.
+def has_filter_indexes(client, collection_name):
+    schema = client.get_collection(collection_name).payload_schema or {}
+    return all(f"metadata.{field}" in schema for field in FILTER_FIELDS)
+
+
+# Translate the filter into what each vector store's similarity_search accepts
+def store_filter(vector_store, conditions):
+    if isinstance(vector_store, Qdrant):
+        return to_qdrant_filter(conditions)
+    if isinstance(vector_store, NumpyVectorStore):
+        return conditions
+    # FAISS takes a predicate over the metadata
+    return lambda metadata: metadata_matches(metadata, conditions)
+
+
+def record_filter(conditions):
+    metrics.increment("lease_assistant_filtered_search_total",
+                      {"filtered": "yes" if conditions else "no"})
+
+
+# Vector retriever that narrows the search with the classified filter. A filtered
+# search over a slice of the collection needs fewer chunks than an unfiltered one;
+# if the slice comes back short the search is repeated without the filter.
+class FilteredVectorRetriever(BaseRetriever):
+    vector_store: Any
+    k: int = 4
+    filtered_k: int = DEFAULT_FILTERED_K
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        conditions = classify_query(query)
+        record_filter(conditions)
+        if conditions:
+            with span("vector_search"):
+                documents = self.vector_store.similarity_search(
+                    query, k=self.filtered_k, filter=store_filter(self.vector_store, conditions))
+            if len(documents) >= self.filtered_k:
+                return documents
+        with span("vector_search"):
+            return self.vector_store.similarity_search(query, k=self.k)
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        conditions = classify_query(query)
+        record_filter(conditions)
+        if conditions:
+            with span("vector_search"):
+                documents = await self.vector_store.asimilarity_search(
+                    query, k=self.filtered_k, filter=store_filter(self.vector_store, conditions))
+            if len(documents) >= self.filtered_k:
+                return documents
+        with span("vector_search"):
+            return await self.vector_store.asimilarity_search(query, k=self.k)
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Defaults for the conversation history store (override with the HISTORY_* settings)
+DEFAULT_HISTORY_PATH = ".cache/history.sqlite3"
+DEFAULT_MAX_TURNS = 50
+DEFAULT_TTL_HOURS = 72
+
+# Questions shown per page of the sidebar history
+PAGE_SIZE = 10
+
+# Sessions idle for longer than the TTL are purged at most this often
+PURGE_INTERVAL_SECONDS = 600
+
+
+# Conversation history kept in SQLite, keyed by session, instead of in
+# st.session_state. Each session keeps at most `max_turns` turns, and sessions idle
+# for longer than `ttl_hours` are dropped. Reads are paged, so the cost of a rerun
+# doesn't grow with the length of the conversation.
+class HistoryStore:
+    def __init__(self, path, max_turns=DEFAULT_MAX_TURNS, ttl_hours=DEFAULT_TTL_HOURS):
+        self.max_turns = int(max_turns)
+        self.ttl_seconds = float(ttl_hours) * 3600
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+        self._conn.commit()
+
+    def append(self, session_id, question, answer):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO turns (session_id, question, answer, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, question, answer, now))
+            self._conn.execute(
+                "DELETE FROM turns WHERE session_id = ? AND id NOT IN "
+                "(SELECT id FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, self.max_turns))
+            if now - self._last_purge > PURGE_INTERVAL_SECONDS:
+                self._conn.execute(
+                    "DELETE FROM turns WHERE session_id IN "
+                    "(SELECT session_id FROM turns GROUP BY session_id HAVING MAX(created_at) < ?)",
+                    (now - self.ttl_seconds,))
+                self._last_purge = now
+            self._conn.commit()
+
+    # The last `limit` (question, answer) turns, oldest first
+    def recent(self, session_id, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question, answer FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit)).fetchall()
+        return [(question, answer) for question, answer in reversed(rows)]
+
+    def count(self, session_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM turns WHERE session_id = ?",
+                                      (session_id,)).fetchone()[0]
+
+    # One page of (turn id, question), newest first; answers are not loaded
+    def titles(self, session_id, page=0, page_size=PAGE_SIZE):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, question FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (session_id, page_size, page * page_size)).fetchall()
+
+    def answer(self, session_id, turn_id):
+        with self._lock:
+            row = self._conn.execute("SELECT answer FROM turns WHERE session_id = ? AND id = ?",
+                                     (session_id, turn_id)).fetchone()
+        return row[0] if row else None
+
+    def clear(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self._conn.commit()
@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import tiktoken
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from qdrant_client import models
+from corpus_router import DEFAULT_CENTROIDS_PATH, refresh_centroids
+from guidance_filters import FILTER_FIELDS, annotate_pages, tag_chunk
+from lease_chain import create_qdrant_client, create_embeddings, get_collection_name
+from lexical_index import LexicalIndex, DEFAULT_INDEX_PATH
+from page_index import PageIndex, DEFAULT_INDEX_PATH as DEFAULT_PAGE_INDEX_PATH
+from settings import get_setting
+from vector_quantization import (QUANTIZATION_MODES, collection_quantization, get_quantization_mode,
+                                 quantization_config)
+
+logger = logging.getLogger(__name__)
+
+# Splitter settings for the guidance documents
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Number of pages handed to a worker process at a time
+PAGES_PER_TASK = 25
+
+# Upper bounds for a single embeddings request
+MAX_BATCH_TOKENS = 100_000
+MAX_BATCH_SIZE = 256
+
+# Namespace for deterministic point ids, so the same chunk always maps to the same point
+POINT_NAMESPACE = uuid.UUID("5b0f3c52-6f1e-4c4e-9a53-6d1f8f3f2a41")
+
+# Page metadata kept from the pdf loader. The document-level fields it also copies onto
+# every page (producer, creationdate, moddate, total_pages, ...) change whenever the pdf
+# is re-issued, which would make every stored chunk look modified.
+PAGE_METADATA_KEYS = ("page", "page_label")
+
+# Payload rewrites sent to Qdrant per request
+PAYLOAD_BATCH_SIZE = 500
+
+
+# Stream pages out of the pdf one at a time instead of loading the whole handbook
+def stream_pages(pdf_path):
+    loader = PyPDFLoader(pdf_path)
+    source = os.path.basename(pdf_path)
+    for page in loader.lazy_load():
+        page.metadata = {key: page.metadata[key] for key in PAGE_METADATA_KEYS if key in page.metadata}
+        page.metadata["source"] = source
+        yield page
+
+
+# Group the page stream into lists of `size` pages
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Runs in a worker process: split a batch of pages into chunks and tag each chunk
+# with its lessee/lessor party and topics
+def split_pages(pages, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [tag_chunk(chunk) for chunk in splitter.split_documents(pages)]
+
+
+# Split the page stream across worker processes, keeping only a few page batches in flight
+# so memory stays flat and chunks come back in page order
+def split_in_parallel(pages, workers=None, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for page_batch in batched(pages, PAGES_PER_TASK):
+            pending.append(executor.submit(split_pages, page_batch, chunk_size, chunk_overlap))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# Hash of the chunk text; unchanged text means the stored vector can be reused
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Give every chunk a content hash and a stable point id. Identical chunks within a
+# source get an occurrence counter so they don't collapse into one point.
+def assign_point_ids(chunks):
+    seen = {}
+    for chunk in chunks:
+        digest = content_hash(chunk.page_content)
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        chunk.metadata["content_hash"] = digest
+        point_id = str(uuid.uuid5(POINT_NAMESPACE, f"{chunk.metadata['source']}:{digest}:{occurrence}"))
+        yield point_id, chunk
+
+
+# Collect the ids and metadata of the points already stored for this source
+def existing_points(client, collection_name, source):
+    existing = {}
+    source_filter = models.Filter(must=[
+        models.FieldCondition(key="metadata.source", match=models.MatchValue(value=source))
+    ])
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=source_filter,
+            with_payload=["metadata"],
+            with_vectors=False,
+            limit=1000,
+            offset=offset,
+        )
+        for point in points:
+            existing[str(point.id)] = (point.payload or {}).get("metadata", {})
+        if offset is None:
+            return existing
+
+
+# Build embedding batches bounded by both token count and number of inputs
+def embedding_batches(items, max_tokens=MAX_BATCH_TOKENS, max_size=MAX_BATCH_SIZE):
+    encoding = tiktoken.get_encoding("cl100k_base")
+    batch, batch_tokens = [], 0
+    for point_id, chunk in items:
+        tokens = len(encoding.encode(chunk.page_content))
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_size):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append((point_id, chunk))
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+# Create the collection, or check that an existing one matches the embedding size and
+# bring its quantization in line with the setting (no re-embedding needed for that).
+# With quantization on, the original vectors live on disk and are only read to rescore.
+def ensure_collection(client, collection_name, vector_size, recreate=False, quantization="none"):
+    exists = client.collection_exists(collection_name)
+    if exists and recreate:
+        client.delete_collection(collection_name)
+        exists = False
+    if not exists:
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE,
+                                               on_disk=quantization != "none"),
+            quantization_config=quantization_config(quantization),
+        )
+    else:
+        config = client.get_collection(collection_name).config
+        if config.params.vectors.size != vector_size:
+            raise ValueError(f"Collection {collection_name} holds {config.params.vectors.size}-dimension vectors "
+                             f"but the embeddings have {vector_size}; use --recreate or another --collection")
+        if collection_quantization(config.quantization_config) != quantization:
+            client.update_collection(
+                collection_name=collection_name,
+                vectors_config={"": models.VectorParamsDiff(on_disk=quantization != "none")},
+                quantization_config=quantization_config(quantization) or models.Disabled.DISABLED,
+            )
+    ensure_payload_indexes(client, collection_name)
+
+
+# Keyword payload indexes: metadata.source keeps the per-source scroll in existing_points
+# cheap, and the filter fields let Qdrant plan filtered searches over the index.
+# Creating an index that already exists is a no-op, so older collections pick up
+# new indexes on the next ingest.
+def ensure_payload_indexes(client, collection_name):
+    for field in ("source",) + FILTER_FIELDS:
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=f"metadata.{field}",
+            field_schema=models.PayloadSchemaType.KEYWORD,
+        )
+
+
+# Payload layout used by langchain's Qdrant vector store
+def to_payload(chunk):
+    return {"page_content": chunk.page_content, "metadata": chunk.metadata}
+
+
+# Rewrite the metadata of many points, several hundred per request
+def update_metadata(client, collection_name, updates, batch_size=PAYLOAD_BATCH_SIZE):
+    for batch in batched(updates, batch_size):
+        client.batch_update_points(
+            collection_name=collection_name,
+            update_operations=[models.SetPayloadOperation(set_payload=models.SetPayload(
+                payload={"metadata": metadata}, points=[point_id])) for point_id, metadata in batch],
+            wait=True,
+        )
+
+
+# Incrementally index a pdf into the Qdrant collection. Only new or changed chunks are
+# embedded; chunks whose text is unchanged but whose metadata moved (e.g. a page shift
+# after an errata insert) only get their payload rewritten, in batched requests. Every chunk, changed or
+# not, goes into the lexical and page indexes when they are passed in.
+def ingest_pdf(pdf_path, client, embeddings, collection_name, workers=None,
+               chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, recreate=False,
+               lexical_index=None, page_index=None, quantization="none"):
+    start = time.perf_counter()
+    source = os.path.basename(pdf_path)
+
+    vector_size = len(embeddings.embed_query("vector size probe"))
+    ensure_collection(client, collection_name, vector_size, recreate=recreate, quantization=quantization)
+
+    existing = existing_points(client, collection_name, source)
+    current_ids = set()
+    to_embed = []
+    to_update = []
+    lexical_documents = []
+    stats = {"chunks": 0, "embedded": 0, "metadata_updated": 0, "unchanged": 0, "deleted": 0}
+
+    pages = annotate_pages(stream_pages(pdf_path))
+    chunks = split_in_parallel(pages, workers, chunk_size, chunk_overlap)
+    for point_id, chunk in assign_point_ids(chunks):
+        stats["chunks"] += 1
+        current_ids.add(point_id)
+        lexical_documents.append(Document(page_content=chunk.page_content,
+                                          metadata={**chunk.metadata, "_id": point_id}))
+        stored_metadata = existing.get(point_id)
+        if stored_metadata is None:
+            to_embed.append((point_id, chunk))
+        elif stored_metadata != chunk.metadata:
+            to_update.append((point_id, chunk.metadata))
+        else:
+            stats["unchanged"] += 1
+
+    update_metadata(client, collection_name, to_update)
+    stats["metadata_updated"] = len(to_update)
+
+    for batch in embedding_batches(to_embed):
+        vectors = embeddings.embed_documents([chunk.page_content for _, chunk in batch])
+        client.upsert(
+            collection_name=collection_name,
+            points=[models.PointStruct(id=point_id, vector=vector, payload=to_payload(chunk))
+                    for (point_id, chunk), vector in zip(batch, vectors)],
+            wait=True,
+        )
+        stats["embedded"] += len(batch)
+        logger.info("Embedded %s/%s new or changed chunks", stats["embedded"], len(to_embed))
+
+    stale_ids = [point_id for point_id in existing if point_id not in current_ids]
+    if stale_ids:
+        client.delete(collection_name=collection_name,
+                      points_selector=models.PointIdsList(points=stale_ids),
+                      wait=True)
+        stats["deleted"] = len(stale_ids)
+
+    if lexical_index is not None:
+        lexical_index.replace_source(source, lexical_documents)
+    if page_index is not None:
+        page_index.replace_source(source, lexical_documents)
+
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index guidance pdfs into the Qdrant collection.")
+    parser.add_argument("pdfs", nargs="+", help="pdf files to index")
+    parser.add_argument("--collection", default=None,
+                        help="collection name (defaults to QDRANT_COLLECTION_NAME)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for splitting")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--recreate", action="store_true",
+                        help="drop and rebuild the collection (use once when migrating a collection built out-of-band)")
+    parser.add_argument("--lexical-index", default=None,
+                        help="where to write the BM25 index (defaults to LEXICAL_INDEX_PATH)")
+    parser.add_argument("--page-index", default=None,
+                        help="where to write the page index (defaults to PAGE_INDEX_PATH)")
+    parser.add_argument("--dimensions", type=int, default=None,
+                        help="embedding size (defaults to EMBEDDING_DIMENSIONS, else the model's full size)")
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default=None,
+                        help="vector quantization (defaults to QDRANT_QUANTIZATION)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    client = create_qdrant_client()
+    embeddings = create_embeddings(dimensions=args.dimensions)
+    quantization = args.quantization or get_quantization_mode()
+    collection_name = args.collection or get_collection_name()
+    lexical_index_path = args.lexical_index or get_setting("LEXICAL_INDEX_PATH", DEFAULT_INDEX_PATH)
+    lexical_index = LexicalIndex() if args.recreate else LexicalIndex.load_or_empty(lexical_index_path)
+    page_index_path = args.page_index or get_setting("PAGE_INDEX_PATH", DEFAULT_PAGE_INDEX_PATH)
+    page_index = PageIndex() if args.recreate else PageIndex.load_or_empty(page_index_path)
+
+    for index, pdf_path in enumerate(args.pdfs):
+        stats = ingest_pdf(pdf_path, client, embeddings, collection_name,
+                           workers=args.workers,
+                           chunk_size=args.chunk_size,
+                           chunk_overlap=args.chunk_overlap,
+                           recreate=args.recreate and index == 0,
+                           lexical_index=lexical_index,
+                           page_index=page_index,
+                           quantization=quantization)
+        print(f"{pdf_path}: {stats}")
+    lexical_index.save(lexical_index_path)
+    page_index.save(page_index_path)
+    # keep the routing centroid in step with the collection
+    refresh_centroids(client, [collection_name],
+                      path=get_setting("CORPUS_CENTROIDS_PATH", DEFAULT_CENTROIDS_PATH))
+
+
+if __name__ == "__main__":
+    main()
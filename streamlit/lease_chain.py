@@ -0,0 +1,453 @@
+import functools
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
+import tiktoken
+from langchain_community.vectorstores import Qdrant
+from langchain_openai import OpenAIEmbeddings
+import qdrant_client
+from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.prompts import PromptTemplate, FewShotPromptTemplate, ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.runnables import RunnableLambda
+from async_pipeline import ThrottledChatOpenAI
+from answer_cache import cache_namespace, corpus_fingerprint
+from corpus_router import (CorpusRouter, DEFAULT_CENTROIDS_PATH, DEFAULT_MARGIN, DEFAULT_TOP_N,
+                           get_corpus_registry, refresh_centroids)
+from context_packer import ApproximateEncoding, pack_documents, DEFAULT_CONTEXT_TOKEN_BUDGET
+from guidance_filters import FilteredVectorRetriever, has_filter_indexes
+from embedding_cache import CachedEmbeddings, DEFAULT_DISK_PATH as DEFAULT_EMBEDDING_CACHE_PATH
+from lexical_index import HybridRetriever, LexicalIndex, DEFAULT_INDEX_PATH as DEFAULT_LEXICAL_INDEX_PATH
+from local_store import DEFAULT_INDEX_DIR, NumpyVectorStore, load_faiss_store, read_manifest
+from rate_limiter import get_scheduler
+from settings import get_setting
+from vector_quantization import RescoringQdrant, get_quantization_mode, rescore_params
+
+logger = logging.getLogger(__name__)
+
+# Set the model name for LLM
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Set the model used to embed the guidance and the questions
+EMBEDDING_MODEL = "text-embedding-3-large"
+
+# Tags marking each stage of the chain, so callback handlers can time them
+REPHRASE_TAG = "stage:rephrase"
+RETRIEVAL_TAG = "stage:retrieval"
+PACK_CONTEXT_TAG = "stage:pack_context"
+GENERATION_TAG = "stage:generation"
+
+
+def get_openai_api_key():
+    return get_setting("LEASE_OPENAI_API_KEY")
+
+
+def get_collection_name():
+    return get_setting("QDRANT_COLLECTION_NAME")
+
+
+# Create an http client with a connection pool. Passing the same client to every
+# OpenAI object lets them reuse open connections instead of each doing its own TLS handshake.
+def create_http_client():
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+
+
+# Async counterpart of create_http_client, for the async pipeline. It must only be
+# used from the event loop it is first used on.
+def create_async_http_client():
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+
+
+# Create a client to connect to Qdrant server
+def create_qdrant_client():
+    return qdrant_client.QdrantClient(
+        get_setting("QDRANT_HOST"),
+        api_key=get_setting("QDRANT_API_KEY")
+        )
+
+
+def create_async_qdrant_client():
+    return qdrant_client.AsyncQdrantClient(
+        get_setting("QDRANT_HOST"),
+        api_key=get_setting("QDRANT_API_KEY")
+        )
+
+
+# EMBEDDING_DIMENSIONS shortens the text-embedding-3 vectors (e.g. 1024 or 256 instead
+# of 3072). The collection must be built with the same setting.
+def get_embedding_dimensions():
+    dimensions = get_setting("EMBEDDING_DIMENSIONS")
+    return int(dimensions) if dimensions else None
+
+
+# Name the embedding caches key on: vectors of different sizes must not be mixed
+def get_embedding_cache_name(dimensions=None):
+    dimensions = dimensions or get_embedding_dimensions()
+    return f"{EMBEDDING_MODEL}:{dimensions}" if dimensions else EMBEDDING_MODEL
+
+
+#initialize embeddings for vector store
+def create_embeddings(http_client=None, http_async_client=None, dimensions=None, max_retries=2):
+    return OpenAIEmbeddings(
+        api_key=get_openai_api_key(),
+        model=EMBEDDING_MODEL,
+        dimensions=dimensions or get_embedding_dimensions(),
+        max_retries=max_retries,
+        http_client=http_client,
+        http_async_client=http_async_client
+    )
+
+
+# Create llm instance. Calls go through the process-wide rate limit scheduler, which
+# also retries them, and async calls share the cap on in-flight LLM calls.
+def create_llm(http_client=None, http_async_client=None):
+    return ThrottledChatOpenAI(api_key=get_openai_api_key(),
+                               model=OPENAI_MODEL,
+                               temperature=0.0,
+                               stream_usage=True,
+                               max_retries=0,
+                               http_client=http_client,
+                               http_async_client=http_async_client)
+
+
+# Which vector store serves retrieval: "qdrant" (remote, default), or a local
+# snapshot exported with local_store.py served by "numpy" or "faiss"
+def get_vector_backend():
+    return str(get_setting("VECTOR_BACKEND", "qdrant")).lower()
+
+
+def get_local_index_dir():
+    return get_setting("LOCAL_INDEX_DIR", DEFAULT_INDEX_DIR)
+
+
+# Define function to access Qdrant vector store
+def get_vector_store(client=None, embeddings=None, async_client=None, collection_name=None):
+    embeddings = embeddings or create_embeddings()
+    backend = get_vector_backend()
+    if backend == "numpy":
+        return NumpyVectorStore.load(get_local_index_dir(), embeddings)
+    if backend == "faiss":
+        return load_faiss_store(get_local_index_dir(), embeddings)
+    if backend != "qdrant":
+        raise ValueError(f"Unknown VECTOR_BACKEND: {backend}")
+
+    #create a vector store with Qdrant and embeddings
+    quantization = get_quantization_mode()
+    if quantization != "none":
+        # search the quantized vectors, then rescore the candidates at full precision
+        return RescoringQdrant(
+            client = client or create_qdrant_client(),
+            collection_name = collection_name or get_collection_name(),
+            embeddings = embeddings,
+            async_client = async_client,
+            search_params = rescore_params(quantization),
+        )
+
+    vector_store = Qdrant(
+        client = client or create_qdrant_client(),
+        collection_name = collection_name or get_collection_name(),
+        embeddings = embeddings,
+        async_client = async_client,
+    )
+
+    return vector_store
+
+
+# Create function to setup prompt template
+def setup_prompt_template():
+    prefix="""You are an expert leases chatbot. You answer questions relating to ASC 842 under US GAAP. Users rely on you to be accurate and thorough in your responses. Please follow the following instructions in constructing your responses:
+1.	You respond to the queries as shown in the provided examples. The responses do not have to be brief. Giving a thorough response is more important than brevity. 
+2.	If your response refers to an example provided, the response needs to include the full example being referenced.
+3.	Your responses will be provided only from the provided vector store source context documents. 
+4.	Your responses will be clear and helpful and will use language that is easy to understand. 
+5.	Your responses will include examples and potential scenarios.  
+6.	If the answer is not available in the vector store source documents, the response will be "I can share general knowledge about lease accounting, but I cannot advise on specific scenarios, please seek guidance from a qualified expert." 
+7.	If the question is not on the topic of leases, respond by saying, "This is outside the scope of what I can help you with. Let's get back to lease accounting.
+8.  Your responses will not include page number references to the KPMG guidance or to the ASC guidance. Your page number references to date have been hallucinations and are not reliable.
+ 
+    
+You will use the provided examples for guidance on how to construct your responses. Your responses should be similar.
+"""
+     
+     # Define examples to instruct app how to respond
+    examples = [
+        {
+            "input": "How do I determine the different lease components?",
+            "answer": """To identify the different lease and nonlease components in a lease contract, both lessees and lessors need to follow specific steps outlined in ASC 842.
+For lessees, lease components are elements of the arrangement that provide the lessee with the right to use an identified asset. The right to use an underlying asset is considered a separate lease component if the lessee can benefit from the asset either on its own or together with other readily available resources, and if the asset is not highly dependent on or highly interrelated with other assets in the contract. This determination is crucial in allocating consideration between lease and nonlease components.
+For lessors, the process is similar but with some differences. Lessors must allocate any capitalized costs, such as initial direct costs or contract costs, to the separate lease components or nonlease components to which those costs relate. Lessors also have the option to elect a practical expedient where they can choose not to separate nonlease components from lease components and account for them as a single component under certain conditions.
+To provide a comprehensive understanding, let's look at an example from the KPMG Leases Handbook:
+Example: A lessor enters into a lease contract with a lessee for the use of equipment. The contract includes maintenance services as a nonlease component. The lessor must identify the separate lease component (equipment) and nonlease component (maintenance services) and allocate consideration accordingly. If the maintenance services are considered a predominant component, the lessor may account for them under Topic 606. Otherwise, the lessor would account for the combined component as an operating lease under ASC 842."""
+
+        },
+        {
+            "input": "How do I account for lease modifications?",
+            "answer": """When accounting for lease modifications, both lessees and lessors have specific considerations to take into account. Let's break down the accounting treatment for both parties:
+
+For lessees, when a lease modification occurs, the lessee must assess whether the modification results in a separate lease or not. If it does, the lessee will account for the modification as a separate lease. This involves recognizing a new right-of-use asset and lease liability based on the remeasured consideration for the modified lease.
+
+If the modification does not result in a separate lease, the lessee will need to remeasure the lease liability and adjust the right-of-use asset based on the remaining consideration in the contract. The lessee must also reassess the lease classification at the modification effective date and account for any initial direct costs, lease incentives, and other payments made to or by the lessee in connection with the modification.
+
+Overall, the accounting treatment for lease modifications for lessees involves careful consideration of the impact on the financial statements and compliance with ASC 842 requirements.
+
+
+For lessors, accounting for lease modifications involves several steps and considerations. When a lease modification occurs, the lessor must first determine if the modified contract is still considered a lease or contains a lease. If it does, the lessor needs to assess whether the modification results in a separate contract or not.
+If the modification results in a separate contract, the lessor will account for two separate contracts: the unmodified original contract and the new separate contract. The new separate contract is accounted for in the same manner as any other new lease. This means that the lessor will recognize any selling profit or loss on the modified lease based on the fair value of the underlying asset at the effective date of the modification.
+On the other hand, if the modification does not result in a separate contract, the lessor will need to remeasure and reallocate the remaining consideration in the contract. The lessor must also reassess the lease classification at the modification effective date and account for any initial direct costs, lease incentives, and other payments made to or by the lessor in connection with the modification.
+The accounting treatment for lease modifications will vary depending on whether the lease classification changes and how it changes. It is essential for lessors to carefully evaluate each modification to ensure compliance with ASC 842 guidelines."""
+
+        }
+    ]
+    
+    #Define format for examples:
+    example_format = "\nQuestion: {input}\n\nAnswer: {answer}"
+    
+    example_prompts = [example_format.format(**ex) for ex in examples]
+    
+    example_template = PromptTemplate(input_variables=['input', 'context'],
+                                      template=example_format)
+    
+    full_prompt = f"{prefix}\n\n" + "\n\n".join(example_prompts) + "\n\nQuestion: {input}\n\nAnswer: "
+    
+    # enriched_history = history + [(input, full_prompt)]
+    
+    #Define suffix for query. The retrieved context goes after the static
+    # instructions and examples, so every request starts with the same prefix
+    # and the provider's prompt caching can reuse it.
+    suffix="""
+
+You will answer the input question based on the provided context:
+
+    <context>
+    {context}
+    </context>
+
+Question: {input}
+Answer: """
+    
+    #Construct FewShotPromptTemplate
+    prompt_template = FewShotPromptTemplate(
+                                            examples=examples,
+                                            example_prompt=example_template,
+                                            input_variables=['input','context'],
+                                            prefix=prefix,
+                                            suffix=suffix,
+                                            example_separator="\n\n")
+    return prompt_template
+
+
+# Compact prompt used to turn a follow-up into a standalone question for retrieval.
+# The full few-shot answer prompt is only needed for generating the answer.
+CONDENSE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Given the conversation so far and a follow-up question about lease accounting, "
+               "rewrite the follow-up as a standalone question that includes any context it needs "
+               "from the conversation. Return only the question."),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+])
+
+# Token budget for the conversation window sent with the condensation prompt
+HISTORY_TOKEN_BUDGET = 1500
+# Earlier answers are long; only the start of each one is kept
+ANSWER_TOKENS_PER_TURN = 300
+
+
+# tiktoken downloads the vocabulary on first use (and caches it under
+# TIKTOKEN_CACHE_DIR). Without network access, e.g. in the offline benchmark, tokens
+# are counted approximately instead. Loaded once per process, so the fallback (and its
+# warning) isn't retried on every question.
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    try:
+        try:
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.warning("Could not load the tiktoken vocabulary; counting tokens approximately", exc_info=True)
+        return ApproximateEncoding()
+
+
+# Turn the (question, answer) history into chat messages, newest turns first, until
+# the token budget is used up. Returned oldest first.
+def trim_history(history, max_tokens=HISTORY_TOKEN_BUDGET, answer_tokens=ANSWER_TOKENS_PER_TURN):
+    encoding = get_encoding()
+    messages = []
+    used = 0
+    for question, answer in reversed(history):
+        question_tokens = len(encoding.encode(question))
+        remaining = max_tokens - used - question_tokens
+        if remaining <= 0:
+            break
+        answer_ids = encoding.encode(answer)[:min(answer_tokens, remaining)]
+        messages = [HumanMessage(question), AIMessage(encoding.decode(answer_ids))] + messages
+        used += question_tokens + len(answer_ids)
+    return messages
+
+
+# Whether retrieval narrows the search with a filter classified from the question
+# (lessee/lessor, topic, chapter). FILTERED_SEARCH is "auto" (the default: only when the
+# Qdrant collection has the filter payload indexes written by ingest.py), "true" or
+# "false". Checked once, when the retriever is built.
+def use_filtered_search(vector_store=None):
+    mode = str(get_setting("FILTERED_SEARCH", "auto")).lower()
+    if mode != "auto":
+        return mode == "true"
+    return isinstance(vector_store, Qdrant) and has_filter_indexes(vector_store.client,
+                                                                   vector_store.collection_name)
+
+
+# Retriever over the guidance: BM25 fused with vector search when a lexical index
+# is available, otherwise vector search
+def create_retriever(vector_store, lexical_index=None, filtered=None):
+    filtered = use_filtered_search(vector_store) if filtered is None else filtered
+    if lexical_index is not None:
+        return HybridRetriever(vector_store=vector_store, lexical_index=lexical_index, filtered=filtered)
+    if filtered:
+        return FilteredVectorRetriever(vector_store=vector_store)
+    return vector_store.as_retriever()
+
+
+# Retriever that routes each question to the closest corpora in the CORPORA registry,
+# or None when only the lease handbook is registered (or a local backend is in use).
+# The lease handbook collection keeps its usual retriever (BM25 hybrid and filters);
+# the other corpora are searched by vector only.
+def create_corpus_router(client, embeddings, async_client=None, lexical_index=None):
+    lease_collection = get_collection_name()
+    registry = get_corpus_registry(lease_collection)
+    if len(registry) < 2 or get_vector_backend() != "qdrant":
+        return None
+    # only collections whose point count changed since the last ingest are recomputed
+    centroids = refresh_centroids(client, list(registry.values()),
+                                  path=get_setting("CORPUS_CENTROIDS_PATH", DEFAULT_CENTROIDS_PATH))
+    retrievers = {}
+    citation_corpus = None
+    for name, collection in registry.items():
+        vector_store = get_vector_store(client, embeddings, async_client, collection_name=collection)
+        if collection == lease_collection:
+            retrievers[name] = create_retriever(vector_store, lexical_index)
+            # codification references are looked up in the handbook's lexical index
+            citation_corpus = name if lexical_index is not None else None
+        else:
+            retrievers[name] = create_retriever(vector_store, filtered=False)
+    return CorpusRouter(
+        retrievers=retrievers,
+        centroids={name: np.asarray(centroids[collection]["centroid"], dtype=np.float32)
+                   for name, collection in registry.items() if collection in centroids},
+        embeddings=embeddings,
+        citation_corpus=citation_corpus,
+        top_n=int(get_setting("CORPUS_TOP_N", DEFAULT_TOP_N)),
+        margin=float(get_setting("CORPUS_MARGIN", DEFAULT_MARGIN)),
+    )
+
+
+def create_history_aware_chain(vector_store, llm=None, lexical_index=None, retriever=None):
+    # Use the shared llm instance when one is passed in
+    llm = llm or create_llm()
+    # Set vector_store as retriever, unless a retriever (e.g. the corpus router) is passed in
+    retriever = retriever or create_retriever(vector_store, lexical_index)
+    # create history aware retriever that will retrieve relevant
+    # segments from source docs. With an empty chat_history the question goes
+    # straight to the retriever and no rephrase call is made.
+    history_aware_retriever_chain = create_history_aware_retriever(
+        llm.with_config(tags=[REPHRASE_TAG]),
+        retriever.with_config(tags=[RETRIEVAL_TAG]),
+        CONDENSE_PROMPT)
+    return history_aware_retriever_chain
+
+
+# create document chain with create_stuff_documents_chain. This
+# tekes the relevant source segments from the history_aware_retriever
+# and "stuffs" them into (something?) that the retrieval chain will reference.
+
+def create_document_chain(prompt_template, llm=None):
+    # Use the shared llm instance when one is passed in
+    llm = llm or create_llm()
+    doc_chain = create_stuff_documents_chain(llm.with_config(tags=[GENERATION_TAG]), prompt_template)
+    return doc_chain
+
+
+def create_retrieve_chain(history_aware_chain, document_chain):
+    retrieval_chain = create_retrieval_chain(history_aware_chain, document_chain)
+    return retrieval_chain
+
+
+# Build the full retrieval chain from an existing vector store and llm
+def build_retrieval_chain(vector_store, llm=None, prompt_template=None, lexical_index=None, retriever=None):
+    prompt_template = prompt_template or setup_prompt_template()
+    history_aware_chain = create_history_aware_chain(vector_store, llm, lexical_index, retriever)
+    # dedupe and trim the retrieved segments to the context budget before they are stuffed
+    encoding = get_encoding()
+    budget = int(get_setting("CONTEXT_TOKEN_BUDGET", DEFAULT_CONTEXT_TOKEN_BUDGET))
+    packed_retriever_chain = history_aware_chain | RunnableLambda(
+        lambda documents: pack_documents(documents, encoding, budget)).with_config(tags=[PACK_CONTEXT_TAG])
+    documents_chain = create_document_chain(prompt_template, llm)
+    return create_retrieve_chain(packed_retriever_chain, documents_chain)
+
+
+# Fingerprint of the corpus behind the active vector backend, used to invalidate
+# cached answers after a re-index
+def get_corpus_fingerprint(client=None):
+    if get_vector_backend() == "qdrant":
+        client = client or create_qdrant_client()
+        collections = sorted(set(get_corpus_registry(get_collection_name()).values()))
+        # the collections are scrolled concurrently
+        with ThreadPoolExecutor(max_workers=len(collections)) as executor:
+            fingerprints = list(executor.map(lambda collection: corpus_fingerprint(client, collection),
+                                             collections))
+        if len(fingerprints) == 1:
+            return fingerprints[0]
+        return hashlib.sha256("".join(fingerprints).encode("utf-8")).hexdigest()
+    # local snapshots record the fingerprint of the collection they were exported from
+    return read_manifest(get_local_index_dir())["fingerprint"]
+
+
+# Namespace for cached answers: model, prompt and corpus, plus the vector size when
+# vectors are shortened, since cached question vectors must match new ones
+def get_answer_namespace(prompt_template, client=None):
+    fingerprint = get_corpus_fingerprint(client)
+    dimensions = get_embedding_dimensions()
+    if dimensions:
+        fingerprint = f"{fingerprint}:{dimensions}"
+    return cache_namespace(OPENAI_MODEL, prompt_template, fingerprint)
+
+
+def get_lexical_index_path():
+    return get_setting("LEXICAL_INDEX_PATH", DEFAULT_LEXICAL_INDEX_PATH)
+
+
+def load_lexical_index(path=None):
+    path = path or get_lexical_index_path()
+    if not os.path.exists(path):
+        return None
+    return LexicalIndex.load(path)
+
+
+# Build the chain outside of Streamlit (command line tools). The app builds the same
+# pieces once per process in resources.py.
+def build_headless_chain():
+    http_client = create_http_client()
+    embeddings = CachedEmbeddings(create_embeddings(http_client=http_client, max_retries=0),
+                                  get_embedding_cache_name(),
+                                  disk_path=get_setting("EMBEDDING_CACHE_PATH", DEFAULT_EMBEDDING_CACHE_PATH),
+                                  scheduler=get_scheduler())
+    client = create_qdrant_client() if get_vector_backend() == "qdrant" else None
+    vector_store = get_vector_store(client=client, embeddings=embeddings)
+    lexical_index = load_lexical_index()
+    chain = build_retrieval_chain(vector_store,
+                                  llm=create_llm(http_client=http_client),
+                                  prompt_template=setup_prompt_template(),
+                                  lexical_index=lexical_index,
+                                  retriever=create_corpus_router(client, embeddings, lexical_index=lexical_index)
+                                  if client else None)
+    return chain, embeddings, client
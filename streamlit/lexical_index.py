@@ -0,0 +1,203 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Any
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from guidance_filters import (DEFAULT_FILTERED_K, classify_query, metadata_matches, record_filter,
+                              store_filter)
+from telemetry import span
+
+# Default location of the lexical index written by ingest.py
+DEFAULT_INDEX_PATH = ".cache/lexical_index.json.gz"
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+# Codification references such as 842-10-15-3 or 842-20-35
+CITATION_PATTERN = re.compile(r"\b\d{3}-\d{2}(?:-\d{2}(?:-\d{1,3})?)?\b")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+# Split text into lowercase words, keeping codification references whole. A reference
+# also emits its shorter prefixes so "842-10-15" matches a chunk citing "842-10-15-3".
+def tokenize(text):
+    text = text.lower()
+    tokens = WORD_PATTERN.findall(text)
+    for citation in CITATION_PATTERN.findall(text):
+        parts = citation.split("-")
+        for end in range(2, len(parts) + 1):
+            tokens.append("-".join(parts[:end]))
+    return tokens
+
+
+def citations_in(text):
+    return CITATION_PATTERN.findall(text)
+
+
+# Key used to match the same chunk coming back from the lexical and the vector side
+def document_key(doc):
+    if "_id" in doc.metadata:
+        return str(doc.metadata["_id"])
+    return hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+
+
+# BM25 inverted index over the ingested chunks. Built at ingestion time and saved as
+# gzipped json, then loaded once per process.
+class LexicalIndex:
+    def __init__(self, documents=None):
+        self.documents = list(documents or [])
+        self._build()
+
+    def _build(self):
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+        for position, doc in enumerate(self.documents):
+            counts = Counter(tokenize(doc.page_content))
+            self.doc_lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                self.postings[term].append((position, frequency))
+        total = len(self.documents)
+        self.average_length = (sum(self.doc_lengths) / total) if total else 0.0
+        self.idf = {term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for term, postings in self.postings.items()}
+
+    # Swap out every chunk of one source, e.g. after re-ingesting a pdf
+    def replace_source(self, source, documents):
+        self.documents = [doc for doc in self.documents if doc.metadata.get("source") != source]
+        self.documents.extend(documents)
+        self._build()
+
+    def search(self, query, k=10):
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, frequency in self.postings[term]:
+                length_norm = 1 - B + B * self.doc_lengths[position] / self.average_length
+                scores[position] += idf * frequency * (K1 + 1) / (frequency + K1 * length_norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[position], score) for position, score in ranked]
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # written to a temporary file and swapped in, so a running app that reloads
+        # the index on a changed mtime never reads a half-written file
+        temp_path = f"{path}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as index_file:
+            json.dump([{"page_content": doc.page_content, "metadata": doc.metadata}
+                       for doc in self.documents], index_file)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as index_file:
+            return cls(Document(**doc) for doc in json.load(index_file))
+
+    @classmethod
+    def load_or_empty(cls, path):
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls()
+
+
+# Reciprocal rank fusion of several ranked document lists
+def reciprocal_rank_fusion(result_lists, rrf_k=60, weights=None):
+    fused = {}
+    scores = defaultdict(float)
+    if weights is None:
+        weights = [1.0] * len(result_lists)
+    for results, weight in zip(result_lists, weights):
+        for rank, doc in enumerate(results):
+            key = document_key(doc)
+            fused.setdefault(key, doc)
+            scores[key] += weight / (rrf_k + rank + 1)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    documents = []
+    for key, score in ranked:
+        doc = fused[key]
+        documents.append(Document(page_content=doc.page_content,
+                                  metadata={**doc.metadata, "score": score}))
+    return documents
+
+
+# Retriever that fuses BM25 results with the vector store's results. Questions that
+# cite a codification reference found verbatim in the lexical hits are answered from
+# the lexical side alone, without an embedding call (the app also skips the answer
+# cache for them, since its lookup embeds the question). With `filtered` set, both sides
+# are narrowed to the metadata filter classified from the question and fewer chunks
+# are returned, falling back to the unfiltered search if the slice comes back short.
+class HybridRetriever(BaseRetriever):
+    vector_store: Any
+    lexical_index: Any
+    k: int = 4
+    fetch_k: int = 10
+    rrf_k: int = 60
+    filtered: bool = False
+    filtered_k: int = DEFAULT_FILTERED_K
+    filtered_fetch_k: int = 6
+
+    def _lexical_results(self, query):
+        with span("lexical_search"):
+            return [doc for doc, _ in self.lexical_index.search(query, self.fetch_k)]
+
+    def _conditions(self, query):
+        if not self.filtered:
+            return {}
+        conditions = classify_query(query)
+        record_filter(conditions)
+        return conditions
+
+    def _filtered_lexical(self, lexical, conditions):
+        return [doc for doc in lexical if metadata_matches(doc.metadata, conditions)][:self.filtered_fetch_k]
+
+    # Lexical hits that contain a codification reference cited in the question
+    def _citation_hits(self, query, lexical):
+        citations = citations_in(query)
+        if not citations:
+            return []
+        return [doc for doc in lexical if any(citation in doc.page_content for citation in citations)]
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        lexical = self._lexical_results(query)
+        exact = self._citation_hits(query, lexical)
+        if exact:
+            return reciprocal_rank_fusion([exact], self.rrf_k)[:self.k]
+        conditions = self._conditions(query)
+        if conditions:
+            with span("vector_search"):
+                dense = self.vector_store.similarity_search(
+                    query, k=self.filtered_fetch_k, filter=store_filter(self.vector_store, conditions))
+            fused = reciprocal_rank_fusion([dense, self._filtered_lexical(lexical, conditions)], self.rrf_k)
+            if len(fused) >= self.filtered_k:
+                return fused[:self.filtered_k]
+        with span("vector_search"):
+            dense = self.vector_store.similarity_search(query, k=self.fetch_k)
+        return reciprocal_rank_fusion([dense, lexical], self.rrf_k)[:self.k]
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        # the BM25 scan is pure Python; keep it off the event loop shared by every session
+        lexical = await asyncio.get_running_loop().run_in_executor(None, self._lexical_results, query)
+        exact = self._citation_hits(query, lexical)
+        if exact:
+            return reciprocal_rank_fusion([exact], self.rrf_k)[:self.k]
+        conditions = self._conditions(query)
+        if conditions:
+            with span("vector_search"):
+                dense = await self.vector_store.asimilarity_search(
+                    query, k=self.filtered_fetch_k, filter=store_filter(self.vector_store, conditions))
+            fused = reciprocal_rank_fusion([dense, self._filtered_lexical(lexical, conditions)], self.rrf_k)
+            if len(fused) >= self.filtered_k:
+                return fused[:self.filtered_k]
+        with span("vector_search"):
+            dense = await self.vector_store.asimilarity_search(query, k=self.fetch_k)
+        return reciprocal_rank_fusion([dense, lexical], self.rrf_k)[:self.k]
@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from answer_cache import fingerprint_point_ids
+
+# Default folder for a local snapshot of the collection
+DEFAULT_INDEX_DIR = ".cache/local_index"
+
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.jsonl"
+MANIFEST_FILE = "manifest.json"
+FAISS_FOLDER = "faiss"
+
+
+# Pull every point (vector + payload) out of a Qdrant collection and write it to
+# `out_dir` as a float32 .npy matrix of unit vectors plus a jsonl file of documents.
+# The matrix is written through a memory map, so the export never holds the whole
+# collection in memory.
+def export_collection(client, collection_name, out_dir, build_faiss=False, embeddings=None):
+    os.makedirs(out_dir, exist_ok=True)
+    total = client.count(collection_name=collection_name, exact=True).count
+    matrix = None
+    point_ids = []
+    row = 0
+    offset = None
+    with open(os.path.join(out_dir, DOCUMENTS_FILE), "w", encoding="utf-8") as documents_file:
+        while True:
+            points, offset = client.scroll(collection_name=collection_name,
+                                           with_payload=True,
+                                           with_vectors=True,
+                                           limit=500,
+                                           offset=offset)
+            for point in points:
+                vector = np.asarray(point.vector, dtype=np.float32)
+                if matrix is None:
+                    matrix = np.lib.format.open_memmap(os.path.join(out_dir, VECTORS_FILE),
+                                                       mode="w+", dtype=np.float32,
+                                                       shape=(total, vector.shape[0]))
+                norm = np.linalg.norm(vector)
+                matrix[row] = vector / norm if norm else vector
+                payload = point.payload or {}
+                metadata = dict(payload.get("metadata") or {})
+                metadata["_id"] = str(point.id)
+                documents_file.write(json.dumps({"page_content": payload.get("page_content", ""),
+                                                 "metadata": metadata}) + "\n")
+                point_ids.append(str(point.id))
+                row += 1
+            if offset is None:
+                break
+    if matrix is not None:
+        matrix.flush()
+        del matrix
+
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w", encoding="utf-8") as manifest_file:
+        json.dump({"collection_name": collection_name,
+                   "points": row,
+                   "fingerprint": fingerprint_point_ids(collection_name, point_ids)}, manifest_file)
+
+    if build_faiss and row:
+        export_faiss(out_dir, embeddings)
+    return row
+
+
+# Build a langchain FAISS index (exact inner product over the unit vectors) from an
+# exported snapshot
+def export_faiss(index_dir, embeddings):
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    vectors = np.load(os.path.join(index_dir, VECTORS_FILE))
+    documents = read_documents(index_dir)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    docstore = InMemoryDocstore({doc.metadata["_id"]: doc for doc in documents})
+    store = FAISS(embeddings, index, docstore,
+                  {position: doc.metadata["_id"] for position, doc in enumerate(documents)},
+                  normalize_L2=True,
+                  distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+    store.save_local(os.path.join(index_dir, FAISS_FOLDER))
+
+
+def read_documents(index_dir):
+    with open(os.path.join(index_dir, DOCUMENTS_FILE), encoding="utf-8") as documents_file:
+        return [Document(**json.loads(line)) for line in documents_file]
+
+
+def read_manifest(index_dir):
+    with open(os.path.join(index_dir, MANIFEST_FILE), encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
+
+
+# Load the FAISS copy of a snapshot. load_local doesn't restore the distance settings,
+# so they are passed again to match export_faiss (inner product over unit vectors).
+def load_faiss_store(index_dir, embeddings):
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+    # the pickle was written by export_faiss on our own machine
+    return FAISS.load_local(os.path.join(index_dir, FAISS_FOLDER), embeddings,
+                            allow_dangerous_deserialization=True,
+                            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+                            normalize_L2=True)
+
+
+# Read-only vector store over an exported snapshot. The matrix is memory-mapped and
+# searched exactly with one matrix-vector product, so there is no network hop.
+class NumpyVectorStore(VectorStore):
+    def __init__(self, vectors, documents, embeddings):
+        self.vectors = vectors
+        self.documents = documents
+        self._embeddings = embeddings
+
+    @classmethod
+    def load(cls, index_dir, embeddings):
+        vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        documents = read_documents(index_dir)
+        # rows past the last document are left over if points were deleted mid-export
+        return cls(vectors[:len(documents)], documents, embeddings)
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("NumpyVectorStore is built with `python streamlit/local_store.py`")
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("NumpyVectorStore is a read-only snapshot")
+
+    # Simple metadata filter: {"key": value} or {"key": [value, ...]}. List-valued
+    # metadata (e.g. topic) matches when any of its values is allowed.
+    def _filter_rows(self, filter):
+        rows = []
+        for row, doc in enumerate(self.documents):
+            for key, expected in filter.items():
+                allowed = expected if isinstance(expected, (list, tuple, set)) else [expected]
+                value = doc.metadata.get(key)
+                values = value if isinstance(value, list) else [value]
+                if not any(item in allowed for item in values):
+                    break
+            else:
+                rows.append(row)
+        return np.asarray(rows, dtype=np.int64)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        if filter:
+            rows = self._filter_rows(filter)
+            if not len(rows):
+                return []
+            scores = self.vectors[rows] @ query
+        else:
+            rows = None
+            scores = self.vectors @ query
+        k = min(k, len(scores))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = []
+        for position in top:
+            row = int(rows[position]) if rows is not None else int(position)
+            results.append((self.documents[row], float(scores[position])))
+        return results
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embeddings.embed_query(query), k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    # scores are already cosine similarities
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+
+def main():
+    from lease_chain import create_qdrant_client, create_embeddings, get_collection_name
+
+    parser = argparse.ArgumentParser(description="Export the Qdrant collection to a local index.")
+    parser.add_argument("--out", default=DEFAULT_INDEX_DIR, help="output folder")
+    parser.add_argument("--collection", default=None,
+                        help="collection name (defaults to QDRANT_COLLECTION_NAME)")
+    parser.add_argument("--faiss", action="store_true", help="also write a FAISS index")
+    args = parser.parse_args()
+
+    collection_name = args.collection or get_collection_name()
+    count = export_collection(create_qdrant_client(), collection_name, args.out,
+                              build_faiss=args.faiss,
+                              embeddings=create_embeddings() if args.faiss else None)
+    print(f"Exported {count} points from {collection_name} to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
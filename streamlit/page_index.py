@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+# Default location of the page index written by ingest.py
+DEFAULT_INDEX_PATH = ".cache/page_index.json"
+
+
+# Chunks are split page by page, so every chunk lives on exactly one page of its source.
+# The index maps each chunk's content hash to that page and records the page count of
+# every source, so answer sources can be turned into page numbers even when their
+# metadata was stripped (e.g. older cached answers).
+class PageIndex:
+    def __init__(self, chunk_pages=None, page_counts=None):
+        # content hash -> [source, zero-based page]
+        self.chunk_pages = dict(chunk_pages or {})
+        self.page_counts = dict(page_counts or {})
+
+    # Swap out every chunk of one source, e.g. after re-ingesting a pdf
+    def replace_source(self, source, chunks):
+        self.chunk_pages = {digest: location for digest, location in self.chunk_pages.items()
+                            if location[0] != source}
+        last_page = -1
+        for chunk in chunks:
+            page = chunk.metadata.get("page")
+            if page is None:
+                continue
+            digest = chunk.metadata.get("content_hash") or _content_hash(chunk.page_content)
+            self.chunk_pages[digest] = [source, int(page)]
+            last_page = max(last_page, int(page))
+        self.page_counts[source] = last_page + 1
+
+    def locate(self, doc):
+        page = doc.metadata.get("page")
+        if page is not None:
+            return doc.metadata.get("source"), int(page)
+        digest = doc.metadata.get("content_hash") or _content_hash(doc.page_content)
+        location = self.chunk_pages.get(digest)
+        return tuple(location) if location else (None, None)
+
+    # Sorted zero-based pages cited by the documents, per source
+    def cited_pages(self, documents):
+        pages = defaultdict(set)
+        for doc in documents:
+            source, page = self.locate(doc)
+            if page is not None:
+                pages[source].add(page)
+        return {source: sorted(source_pages) for source, source_pages in pages.items()}
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as index_file:
+            json.dump({"chunk_pages": self.chunk_pages, "page_counts": self.page_counts}, index_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as index_file:
+            data = json.load(index_file)
+        return cls(data["chunk_pages"], data["page_counts"])
+
+    @classmethod
+    def load_or_empty(cls, path):
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls()
+
+
+def _content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Pages in a "?pages=12,13" query parameter are one-based, as shown to users
+def parse_page_param(value):
+    pages = set()
+    for part in (value or "").split(","):
+        part = part.strip()
+        if part.isdigit() and int(part) > 0:
+            pages.add(int(part) - 1)
+    return sorted(pages)
+
+
+def format_page_param(pages):
+    return ",".join(str(page + 1) for page in pages)
@@ -1,4 +1,7 @@
+import os
 import streamlit as st
+from page_index import parse_page_param, format_page_param
+from settings import get_setting
 
 # Set up Streamlit page configuration
 st.set_page_config(page_title=None,
@@ -7,12 +10,67 @@ st.set_page_config(page_title=None,
                    initial_sidebar_state="auto",
                    menu_items=None)
 
+# Full handbook, used when no local copy is configured
+PDF_URL = "https://drive.google.com/file/d/1rw9pFMMYAQsEV3k_1UWbA3SOAa8Oedqs/preview"  # Update this to your actual PDF URL
+
+# Resolution of rendered page images
+RENDER_SCALE = 1.5
+
 def show_pdf(pdf_url):
     st.markdown(
         f"<iframe src='{pdf_url}' width='130%' height='700' style='border:none; margin-left: -150px;'></iframe>",
         unsafe_allow_html=True
     )
 
+# Local copy of the handbook (GUIDANCE_PDF_PATH), or None to fall back to the iframe
+def get_pdf_path():
+    path = get_setting("GUIDANCE_PDF_PATH")
+    return path if path and os.path.exists(path) else None
+
+@st.cache_data
+def count_pages(pdf_path):
+    from pypdf import PdfReader
+    return len(PdfReader(pdf_path).pages)
+
+# Pages are rendered one at a time, only when shown, and cached for every session
+@st.cache_data(max_entries=64)
+def render_page_image(pdf_path, page):
+    try:
+        import pypdfium2
+    except ImportError:
+        return None
+    document = pypdfium2.PdfDocument(pdf_path)
+    try:
+        image = document[page].render(scale=RENDER_SCALE).to_pil()
+    finally:
+        document.close()
+    return image
+
+@st.cache_data(max_entries=256)
+def extract_page_text(pdf_path, page):
+    from pypdf import PdfReader
+    return PdfReader(pdf_path).pages[page].extract_text()
+
+# Pages cited by the last answer (set by the Lease Assistant page), or the
+# one-based pages in a shared "?pages=12,13" link
+def get_cited_pages(pdf_path):
+    if "pages" in st.query_params:
+        return parse_page_param(st.query_params["pages"])
+    cited = st.session_state.get('cited_pages', {})
+    source = os.path.basename(pdf_path)
+    if source in cited:
+        return cited[source]
+    # chunks indexed without a source name
+    return cited.get(None, [])
+
+def show_page(pdf_path, page):
+    st.markdown(f"**Page {page + 1}**")
+    image = render_page_image(pdf_path, page)
+    if image is not None:
+        st.image(image, use_container_width=True)
+    else:
+        st.write(extract_page_text(pdf_path, page).replace("$", "\$"))
+
 def main():
     st.markdown("""
         <style>
@@ -23,13 +81,31 @@ def main():
         }
         </style>
     """, unsafe_allow_html=True)
-    
+
     st.markdown('<h1 class="title">KPMG Leases Handbook</h1>', unsafe_allow_html=True)
-    
-    # st.title('PDF Viewer for Document 1')
-    pdf_url = "https://drive.google.com/file/d/1rw9pFMMYAQsEV3k_1UWbA3SOAa8Oedqs/preview"  # Update this to your actual PDF URL
-    show_pdf(pdf_url)
+
+    pdf_path = get_pdf_path()
+    if pdf_path is None:
+        show_pdf(PDF_URL)
+        return
+
+    total_pages = count_pages(pdf_path)
+    cited_pages = [page for page in get_cited_pages(pdf_path) if page < total_pages]
+    if cited_pages:
+        st.write("Pages cited by the last answer:")
+        page = st.radio("Cited page", cited_pages, format_func=lambda page: f"Page {page + 1}",
+                        horizontal=True, label_visibility="collapsed")
+        st.query_params["pages"] = format_page_param(cited_pages)
+    else:
+        st.write("Ask the Lease Assistant a question to see the pages its answer is based on, or browse below.")
+        page = None
+
+    # browsing any other page still only renders that one page
+    browse = st.number_input(f"Go to page (1-{total_pages})", min_value=1, max_value=total_pages,
+                             value=(page if page is not None else 0) + 1)
+    if page is None or browse != page + 1:
+        page = browse - 1
+    show_page(pdf_path, page)
 
 if __name__ == "__main__":
     main()
-
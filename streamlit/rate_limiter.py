@@ -0,0 +1,379 @@
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import openai
+import tiktoken
+from settings import get_setting
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+# Call priorities; lower is served first
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch", BACKGROUND: "background"}
+
+# Completion tokens assumed for a chat call with no max_tokens, until its usage is known
+DEFAULT_OUTPUT_TOKENS = 500
+
+# Retries of a call that failed with a retryable error, and the back-off between them
+MAX_ATTEMPTS = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+# How often waiting coroutines re-check whether it is their turn
+ASYNC_POLL_SECONDS = 0.05
+
+_priority = contextvars.ContextVar("openai_call_priority", default=INTERACTIVE)
+
+
+# Calls made inside the block (on this thread, or in executors that copy the
+# context, as langchain's do) are scheduled at `priority`
+@contextmanager
+def priority_scope(priority):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(texts, model_name):
+    encoding = _encoding(model_name)
+    return sum(len(encoding.encode(text)) for text in texts)
+
+
+# Share of each limit held back from lower-priority calls. Priorities between calls in
+# one process are strict; across processes (a batch run next to the app) the reserve is
+# what keeps batch and background work from using up the budget interactive questions need.
+PRIORITY_RESERVE = {INTERACTIVE: 0.0, BATCH: 0.25, BACKGROUND: 0.5}
+
+# Where the shared buckets live (override with RATE_LIMIT_STATE_PATH)
+DEFAULT_STATE_PATH = ".cache/rate_limits.sqlite3"
+
+
+# Token buckets for the organization's limits and the 429 pause, kept in a SQLite file
+# so every process on the machine using the same file (the app, batch_runner.py,
+# warmup.py) draws from one budget. Each bucket refills continuously and holds at most
+# one minute's worth.
+class SharedLimits:
+    def __init__(self, path, tokens_per_minute=None, requests_per_minute=None):
+        self.capacities = {name: float(limit) for name, limit in
+                           (("tokens", tokens_per_minute), ("requests", requests_per_minute)) if limit}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # transactions are opened explicitly, with BEGIN IMMEDIATE, so a read-modify-write
+        # of the buckets can't interleave with another process's
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pauses (name TEXT PRIMARY KEY, until REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    # Bucket levels refilled up to `now`. Must be called inside a transaction.
+    def _levels(self, now):
+        levels = {}
+        for name, capacity in self.capacities.items():
+            row = self._conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                levels[name] = capacity
+            else:
+                levels[name] = min(capacity, row[0] + max(now - row[1], 0.0) * capacity / 60.0)
+        return levels
+
+    def _save(self, levels, now):
+        self._conn.executemany("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                               [(name, level, now) for name, level in levels.items()])
+
+    # Take `amounts` ({bucket: amount}) from the buckets if the caller's priority may,
+    # returning 0; otherwise the seconds until it could. A call larger than what the
+    # priority may use at once waits for that much instead.
+    def try_take(self, amounts, priority):
+        reserve = PRIORITY_RESERVE.get(priority, max(PRIORITY_RESERVE.values()))
+        now = time.time()
+        with self._transaction():
+            row = self._conn.execute("SELECT until FROM pauses WHERE name = 'openai'").fetchone()
+            wait = max((row[0] if row else 0.0) - now, 0.0)
+            levels = self._levels(now)
+            wanted = {}
+            for name, capacity in self.capacities.items():
+                floor = capacity * reserve
+                wanted[name] = min(amounts.get(name, 0), capacity - floor)
+                if levels[name] - wanted[name] < floor:
+                    wait = max(wait, (floor + wanted[name] - levels[name]) * 60.0 / capacity)
+            if wait > 0:
+                return wait
+            self._save({name: levels[name] - wanted[name] for name in levels}, now)
+            return 0.0
+
+    # Charge (or refund) a bucket once the real usage is known
+    def adjust(self, name, amount):
+        if name not in self.capacities:
+            return
+        now = time.time()
+        with self._transaction():
+            level = self._levels(now)[name]
+            self._save({name: min(self.capacities[name], level - amount)}, now)
+
+    # Hold every caller, in every process, for `seconds`
+    def pause(self, seconds):
+        until = time.time() + seconds
+        with self._transaction():
+            row = self._conn.execute("SELECT until FROM pauses WHERE name = 'openai'").fetchone()
+            if row is None or row[0] < until:
+                self._conn.execute("INSERT OR REPLACE INTO pauses (name, until) VALUES ('openai', ?)", (until,))
+
+
+# Admits OpenAI calls through the shared token buckets sized to the organization's TPM
+# and RPM limits, so bursts queue here instead of turning into 429s. Within a process
+# waiting calls are admitted in priority order (FIFO within a priority); across
+# processes lower priorities only get the part of the budget not reserved for higher
+# ones. When a 429 does come back every caller pauses, with jitter, instead of
+# retrying straight into the limit. Without configured limits calls are admitted
+# immediately, without touching the shared file, and share the 429 back-off only
+# within the process.
+#
+# The shared buckets are SQLite transactions, so they run outside the condition lock
+# (sync callers don't hold up each other's bookkeeping while one waits on the file)
+# and, for async callers, on a worker thread instead of the event loop.
+class RateLimitScheduler:
+    def __init__(self, tokens_per_minute=None, requests_per_minute=None, state_path=DEFAULT_STATE_PATH):
+        self.tokens_per_minute = tokens_per_minute
+        self.limits = None
+        if tokens_per_minute or requests_per_minute:
+            self.limits = SharedLimits(state_path, tokens_per_minute, requests_per_minute)
+        # 429 pause (time.monotonic) when there are no shared limits
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def _is_next(self, ticket):
+        with self._condition:
+            return self._waiting[0] == ticket
+
+    # 0 if the ticket was admitted, otherwise how long to wait (None when calls ahead
+    # of it are still waiting). Only the ticket at the head of the queue takes from the
+    # buckets, so calls are still admitted one at a time in priority order.
+    def _poll(self, ticket, tokens):
+        if not self._is_next(ticket):
+            return None
+        if self.limits is None:
+            wait = max(self._paused_until - time.monotonic(), 0.0)
+        else:
+            wait = self.limits.try_take({"tokens": tokens, "requests": 1}, ticket[0])
+        if wait > 0:
+            return wait
+        self._discard(ticket)
+        return 0.0
+
+    async def _apoll(self, ticket, tokens):
+        if self.limits is None:
+            return self._poll(ticket, tokens)
+        return await asyncio.to_thread(self._poll, ticket, tokens)
+
+    def _enqueue(self, priority):
+        ticket = (_priority.get() if priority is None else priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _discard(self, ticket):
+        with self._condition:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def _record_wait(self, ticket, start):
+        metrics.observe("lease_assistant_rate_limit_wait_seconds", time.perf_counter() - start,
+                        {"priority": PRIORITY_NAMES.get(ticket[0], str(ticket[0]))})
+
+    def acquire(self, tokens, priority=None):
+        ticket = self._enqueue(priority)
+        start = time.perf_counter()
+        admitted = False
+        try:
+            while True:
+                wait = self._poll(ticket, tokens)
+                if wait == 0:
+                    admitted = True
+                    break
+                with self._condition:
+                    # re-checked under the lock, so an admission notified since the
+                    # poll isn't missed; async waiters don't notify, so never wait
+                    # indefinitely
+                    if wait is not None or self._waiting[0] != ticket:
+                        self._condition.wait(min(wait, 1.0) if wait is not None else 0.25)
+        finally:
+            if not admitted:
+                self._discard(ticket)
+        self._record_wait(ticket, start)
+
+    async def aacquire(self, tokens, priority=None):
+        ticket = self._enqueue(priority)
+        start = time.perf_counter()
+        admitted = False
+        try:
+            while True:
+                wait = await self._apoll(ticket, tokens)
+                if wait == 0:
+                    admitted = True
+                    break
+                await asyncio.sleep(min(wait, 1.0) if wait is not None else ASYNC_POLL_SECONDS)
+        finally:
+            if not admitted:
+                self._discard(ticket)
+        self._record_wait(ticket, start)
+
+    # Tokens a call is expected to use: its input, counted with tiktoken, plus the
+    # expected output. Skipped (0) when there is no TPM limit to charge it against.
+    def estimate(self, texts, model_name, output_tokens=0):
+        if not self.tokens_per_minute:
+            return 0
+        return count_tokens(texts, model_name) + output_tokens
+
+    # Correct the token bucket once the usage reported by the API is known
+    def settle(self, estimated, actual):
+        if actual and self.limits is not None:
+            self.limits.adjust("tokens", actual - estimated)
+
+    async def asettle(self, estimated, actual):
+        if actual and self.limits is not None:
+            await asyncio.to_thread(self.settle, estimated, actual)
+
+    def _pause(self, seconds):
+        if self.limits is not None:
+            self.limits.pause(seconds)
+        else:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    # Seconds the failed caller should sleep before retrying. A 429 pauses admissions
+    # for everyone (honouring Retry-After when the API sends it), so the retry just
+    # queues up again; other errors only back off the caller.
+    def _retry_delay(self, attempt, error):
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        if isinstance(error, openai.RateLimitError):
+            retry_after = _retry_after(error)
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, BASE_DELAY)
+            self._pause(delay)
+            metrics.increment("lease_assistant_rate_limited_total")
+            logger.warning("Rate limited by OpenAI; pausing calls for %.1fs", delay)
+            return 0.0
+        return delay
+
+    async def _aretry_delay(self, attempt, error):
+        if self.limits is None:
+            return self._retry_delay(attempt, error)
+        return await asyncio.to_thread(self._retry_delay, attempt, error)
+
+    def run(self, call, tokens, priority=None):
+        for attempt in range(MAX_ATTEMPTS):
+            self.acquire(tokens, priority)
+            try:
+                return call()
+            except RETRYABLE_ERRORS as error:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(self._retry_delay(attempt, error))
+
+    async def arun(self, call, tokens, priority=None):
+        for attempt in range(MAX_ATTEMPTS):
+            await self.aacquire(tokens, priority)
+            try:
+                return await call()
+            except RETRYABLE_ERRORS as error:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(await self._aretry_delay(attempt, error))
+
+    # Streams are only retried if they fail before the first chunk
+    def stream(self, start, tokens, priority=None):
+        for attempt in range(MAX_ATTEMPTS):
+            self.acquire(tokens, priority)
+            started = False
+            try:
+                for chunk in start():
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as error:
+                if started or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(self._retry_delay(attempt, error))
+
+    async def astream(self, start, tokens, priority=None):
+        for attempt in range(MAX_ATTEMPTS):
+            await self.aacquire(tokens, priority)
+            started = False
+            try:
+                async for chunk in start():
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as error:
+                if started or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(await self._aretry_delay(attempt, error))
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+# The process-wide scheduler, sized from OPENAI_TPM_LIMIT and OPENAI_RPM_LIMIT and
+# sharing its buckets with the other processes that use RATE_LIMIT_STATE_PATH
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            tpm = get_setting("OPENAI_TPM_LIMIT")
+            rpm = get_setting("OPENAI_RPM_LIMIT")
+            _scheduler = RateLimitScheduler(tokens_per_minute=float(tpm) if tpm else None,
+                                            requests_per_minute=float(rpm) if rpm else None,
+                                            state_path=get_setting("RATE_LIMIT_STATE_PATH", DEFAULT_STATE_PATH))
+        return _scheduler
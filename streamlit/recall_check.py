@@ -0,0 +1,144 @@
+import argparse
+import json
+import random
+import statistics
+import time
+from qdrant_client import models
+from batch_runner import read_questions
+from lease_chain import create_embeddings, create_qdrant_client, get_collection_name
+from vector_quantization import DEFAULT_OVERSAMPLING, collection_quantization, rescore_params
+from warmup import DEFAULT_CANNED_QUESTIONS
+
+# Compare a reduced-dimension and/or quantized collection against the full-precision
+# one built from the same pdfs:
+#
+#   python streamlit/ingest.py handbook.pdf --collection leases_1024_binary --dimensions 1024 --quantization binary
+#   python streamlit/recall_check.py --candidate leases_1024_binary --k 4 --sample 200
+#
+# Ingestion derives point ids from the chunk content, so the same chunk has the same
+# id in both collections and the result lists can be compared id by id. Recall@k is
+# the share of the reference's exact top k that the candidate also returns.
+
+
+def collection_summary(client, collection_name):
+    info = client.get_collection(collection_name)
+    mode = collection_quantization(info.config.quantization_config)
+    dimensions = info.config.params.vectors.size
+    points = info.points_count or 0
+    # bytes the search keeps in RAM: the quantized codes, or the float32 vectors
+    bytes_per_vector = {"none": dimensions * 4, "scalar": dimensions, "binary": dimensions / 8}[mode]
+    return {"collection": collection_name,
+            "dimensions": dimensions,
+            "quantization": mode,
+            "points": points,
+            "search_vectors_mb": round(points * bytes_per_vector / 2**20, 1)}
+
+
+# Questions to probe with: a file, and/or the first sentence of randomly sampled chunks
+def probe_questions(client, collection_name, questions_path=None, sample=0, seed=7):
+    questions = [item["question"] for item in read_questions(questions_path)] if questions_path else []
+    if sample:
+        points, _ = client.scroll(collection_name=collection_name, with_payload=["page_content"],
+                                  with_vectors=False, limit=max(sample * 5, 1000))
+        rng = random.Random(seed)
+        for point in rng.sample(points, min(sample, len(points))):
+            text = (point.payload or {}).get("page_content", "")
+            sentence = text.split(". ")[0][:300].strip()
+            if sentence:
+                questions.append(sentence)
+    return questions or list(DEFAULT_CANNED_QUESTIONS)
+
+
+def search_ids(client, collection_name, vector, k, search_params=None):
+    start = time.perf_counter()
+    points = client.query_points(collection_name=collection_name, query=vector, limit=k,
+                                 search_params=search_params, with_payload=False).points
+    return [str(point.id) for point in points], time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_check(client, reference, candidate, questions, k=4, oversampling=None):
+    reference_info = collection_summary(client, reference)
+    candidate_info = collection_summary(client, candidate)
+    reference_embeddings = create_embeddings(dimensions=reference_info["dimensions"])
+    candidate_embeddings = create_embeddings(dimensions=candidate_info["dimensions"])
+    reference_vectors = reference_embeddings.embed_documents(questions)
+    candidate_vectors = candidate_embeddings.embed_documents(questions)
+
+    mode = candidate_info["quantization"]
+    # exact search over the candidate's full-precision vectors isolates the loss
+    # from the shorter vectors alone
+    variants = {"exact": models.SearchParams(exact=True,
+                                             quantization=models.QuantizationSearchParams(ignore=True))}
+    if mode != "none":
+        variants["rescored"] = rescore_params(mode, oversampling=oversampling or DEFAULT_OVERSAMPLING[mode])
+        variants["quantized_only"] = rescore_params(mode, rescore=False)
+    else:
+        variants["hnsw"] = None
+
+    reference_latencies = []
+    recalls = {name: [] for name in variants}
+    latencies = {name: [] for name in variants}
+    for reference_vector, candidate_vector in zip(reference_vectors, candidate_vectors):
+        expected, _ = search_ids(client, reference, reference_vector, k, models.SearchParams(exact=True))
+        _, seconds = search_ids(client, reference, reference_vector, k)
+        reference_latencies.append(seconds)
+        for name, search_params in variants.items():
+            found, seconds = search_ids(client, candidate, candidate_vector, k, search_params)
+            latencies[name].append(seconds)
+            recalls[name].append(len(set(expected) & set(found)) / max(len(expected), 1))
+
+    report = {"k": k,
+              "questions": len(questions),
+              "reference": {**reference_info,
+                            "p50_ms": round(statistics.median(reference_latencies) * 1000, 2)},
+              "candidate": candidate_info,
+              "variants": {}}
+    for name in variants:
+        report["variants"][name] = {
+            "recall_at_k": round(statistics.mean(recalls[name]), 4),
+            "p50_ms": round(statistics.median(latencies[name]) * 1000, 2),
+            "p95_ms": round(percentile(latencies[name], 0.95) * 1000, 2),
+        }
+    return report
+
+
+def print_report(report):
+    reference, candidate = report["reference"], report["candidate"]
+    print(f"{report['questions']} questions, recall@{report['k']} against {reference['collection']} "
+          f"({reference['dimensions']}d, {reference['search_vectors_mb']} MB, p50 {reference['p50_ms']} ms)")
+    print(f"candidate {candidate['collection']}: {candidate['dimensions']}d, "
+          f"quantization {candidate['quantization']}, {candidate['search_vectors_mb']} MB")
+    print(f"{'search':<16}{'recall@k':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, values in report["variants"].items():
+        print(f"{name:<16}{values['recall_at_k']:>10.3f}{values['p50_ms']:>10.2f}{values['p95_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k of a reduced/quantized collection vs full precision.")
+    parser.add_argument("--candidate", required=True, help="collection built with reduced dimensions/quantization")
+    parser.add_argument("--reference", default=None,
+                        help="full-precision collection (defaults to QDRANT_COLLECTION_NAME)")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--questions", default=None, help="CSV or jsonl of questions (as for batch_runner.py)")
+    parser.add_argument("--sample", type=int, default=0, help="also probe with this many sampled chunk sentences")
+    parser.add_argument("--oversampling", type=float, default=None, help="rescoring oversampling factor")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+
+    client = create_qdrant_client()
+    reference = args.reference or get_collection_name()
+    questions = probe_questions(client, reference, args.questions, args.sample)
+    report = run_check(client, reference, args.candidate, questions, k=args.k, oversampling=args.oversampling)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
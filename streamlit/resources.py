@@ -0,0 +1,261 @@
+import logging
+import os
+import threading
+import streamlit as st
+from lease_chain import (get_embedding_cache_name, create_http_client, create_qdrant_client, create_embeddings,
+                         create_async_http_client, create_async_qdrant_client,
+                         create_llm, get_vector_store, setup_prompt_template,
+                         build_retrieval_chain, get_vector_backend, get_answer_namespace,
+                         load_lexical_index, get_lexical_index_path, create_corpus_router)
+from async_pipeline import EventLoopThread
+from answer_cache import (SemanticAnswerCache, NamespaceMonitor,
+                          DEFAULT_CACHE_PATH, DEFAULT_THRESHOLD, DEFAULT_TTL_HOURS,
+                          DEFAULT_MAX_ENTRIES)
+from embedding_cache import (CachedEmbeddings, DEFAULT_MAX_ENTRIES as DEFAULT_EMBEDDING_CACHE_ENTRIES,
+                             DEFAULT_DISK_PATH as DEFAULT_EMBEDDING_CACHE_PATH)
+from history_store import (HistoryStore, DEFAULT_HISTORY_PATH, DEFAULT_MAX_TURNS,
+                           DEFAULT_TTL_HOURS as DEFAULT_HISTORY_TTL_HOURS)
+from page_index import PageIndex, DEFAULT_INDEX_PATH as DEFAULT_PAGE_INDEX_PATH
+from rate_limiter import get_scheduler
+from settings import get_setting
+from single_flight import SingleFlight
+from telemetry import StageCallbackHandler, metrics, start_metrics_server
+from warmup import get_canned_questions, run_warmup
+
+logger = logging.getLogger(__name__)
+
+# Process-wide resources. st.cache_resource builds each object once per server
+# process and hands the same instance to every session and every question, so the
+# Qdrant client, the OpenAI clients and their connection pools are not rebuilt per request.
+
+
+@st.cache_resource
+def get_http_client():
+    return create_http_client()
+
+
+@st.cache_resource
+def get_qdrant_client():
+    return create_qdrant_client()
+
+
+# Event loop thread that runs the async pipeline for every session
+@st.cache_resource
+def get_event_loop_thread():
+    return EventLoopThread()
+
+
+# Shared async clients; they are only ever used on the event loop thread above
+@st.cache_resource
+def get_async_http_client():
+    return create_async_http_client()
+
+
+@st.cache_resource
+def get_async_qdrant_client():
+    return create_async_qdrant_client()
+
+
+# Metrics sinks: a Prometheus text endpoint on METRICS_PORT and/or a jsonl file of
+# timing events at METRICS_JSONL_PATH. Both are off unless configured.
+@st.cache_resource
+def init_telemetry():
+    metrics.jsonl_path = get_setting("METRICS_JSONL_PATH")
+    port = get_setting("METRICS_PORT")
+    return start_metrics_server(port) if port else None
+
+
+# Callback handler passed with every chain call to time the stages
+@st.cache_resource
+def get_stage_handler():
+    return StageCallbackHandler()
+
+
+def use_async_pipeline():
+    return str(get_setting("ASYNC_PIPELINE", "true")).lower() == "true"
+
+
+# Question embeddings are memoized, so repeated questions (and the answer cache
+# lookup followed by retrieval) only pay for one embeddings call
+@st.cache_resource
+def get_embeddings():
+    return CachedEmbeddings(create_embeddings(http_client=get_http_client(),
+                                              http_async_client=get_async_http_client(),
+                                              max_retries=0),
+                            get_embedding_cache_name(),
+                            max_entries=get_setting("EMBEDDING_CACHE_MAX_ENTRIES", DEFAULT_EMBEDDING_CACHE_ENTRIES),
+                            disk_path=get_setting("EMBEDDING_CACHE_PATH", DEFAULT_EMBEDDING_CACHE_PATH),
+                            scheduler=get_scheduler())
+
+
+@st.cache_resource
+def get_llm():
+    return create_llm(http_client=get_http_client(), http_async_client=get_async_http_client())
+
+
+@st.cache_resource
+def get_shared_vector_store():
+    if get_vector_backend() != "qdrant":
+        return get_vector_store(embeddings=get_embeddings())
+    return get_vector_store(client=get_qdrant_client(),
+                            embeddings=get_embeddings(),
+                            async_client=get_async_qdrant_client())
+
+
+@st.cache_resource
+def get_prompt_template():
+    return setup_prompt_template()
+
+
+# Modification time of the BM25 index file, or None if it hasn't been built yet.
+# The index and everything built on it are cached per version, so a re-run of
+# ingest.py is picked up on the next rerun without restarting the app.
+def get_lexical_index_version():
+    try:
+        return os.stat(get_lexical_index_path()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@st.cache_resource(max_entries=1)
+def _load_lexical_index(path, version):
+    return load_lexical_index(path)
+
+
+# BM25 index written by ingest.py (None if not built yet)
+def get_lexical_index():
+    return _load_lexical_index(get_lexical_index_path(), get_lexical_index_version())
+
+
+# Chunk -> page map written by ingest.py, used to link answer sources to the guidance viewer
+@st.cache_resource
+def get_page_index():
+    return PageIndex.load_or_empty(get_setting("PAGE_INDEX_PATH", DEFAULT_PAGE_INDEX_PATH))
+
+
+# Router over the collections in the CORPORA registry (None with a single corpus)
+@st.cache_resource(max_entries=1)
+def _build_corpus_router(lexical_index_version):
+    if get_vector_backend() != "qdrant":
+        return None
+    return create_corpus_router(get_qdrant_client(), get_embeddings(), get_async_qdrant_client(),
+                                lexical_index=get_lexical_index())
+
+
+def get_corpus_router():
+    return _build_corpus_router(get_lexical_index_version())
+
+
+# The chain is stateless between calls (history is passed in with the input),
+# so a single instance can safely serve every session
+@st.cache_resource(max_entries=1)
+def _build_retrieval_chain(lexical_index_version):
+    return build_retrieval_chain(get_shared_vector_store(),
+                                 llm=get_llm(),
+                                 prompt_template=get_prompt_template(),
+                                 lexical_index=get_lexical_index(),
+                                 retriever=get_corpus_router())
+
+
+def get_retrieval_chain():
+    return _build_retrieval_chain(get_lexical_index_version())
+
+
+# Conversation history for every session, kept out of st.session_state
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(get_setting("HISTORY_DB_PATH", DEFAULT_HISTORY_PATH),
+                        max_turns=get_setting("HISTORY_MAX_TURNS", DEFAULT_MAX_TURNS),
+                        ttl_hours=get_setting("HISTORY_TTL_HOURS", DEFAULT_HISTORY_TTL_HOURS))
+
+
+# Coalesces identical questions that are being answered at the same time
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+
+# Semantic answer cache shared by every session, or None when disabled
+@st.cache_resource
+def get_answer_cache():
+    if str(get_setting("ANSWER_CACHE_ENABLED", "true")).lower() != "true":
+        return None
+    return SemanticAnswerCache(
+        get_setting("ANSWER_CACHE_PATH", DEFAULT_CACHE_PATH),
+        get_embeddings(),
+        threshold=get_setting("ANSWER_CACHE_THRESHOLD", DEFAULT_THRESHOLD),
+        ttl_hours=get_setting("ANSWER_CACHE_TTL_HOURS", DEFAULT_TTL_HOURS),
+        max_entries=get_setting("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+    )
+
+
+def _warmup_enabled():
+    return str(get_setting("WARMUP_ENABLED", "true")).lower() == "true"
+
+
+# Handler for namespace changes that pre-answers the canned example questions into
+# the answer cache under the new namespace, or None when there is nothing to pin.
+# The shared resources are fetched here on the script thread and handed to the worker.
+def _pinned_answers_warmup():
+    answer_cache = get_answer_cache()
+    if not _warmup_enabled() or answer_cache is None:
+        return None
+    chain = get_retrieval_chain()
+    config = {'callbacks': [get_stage_handler()]}
+    questions = get_canned_questions()
+
+    def warm(namespace):
+        try:
+            run_warmup(chain, answer_cache, namespace, questions, config=config)
+        except Exception:
+            logger.exception("Warmup failed")
+
+    # on its own thread, so a long warmup doesn't hold up the next namespace check
+    def on_change(namespace):
+        threading.Thread(target=warm, args=(namespace,), name="warmup", daemon=True).start()
+
+    return on_change
+
+
+# Recomputes the answer cache namespace on a background thread every few minutes, so
+# a re-indexed collection invalidates the cached answers without fingerprinting the
+# corpus during a user's Submit. Each new namespace (the first one included) is
+# warmed up again, since storing under it drops the answers pinned under the old one.
+@st.cache_resource
+def get_namespace_monitor():
+    client = get_qdrant_client() if get_vector_backend() == "qdrant" else None
+    prompt_template = get_prompt_template()
+    return NamespaceMonitor(lambda: get_answer_namespace(prompt_template, client),
+                            on_change=_pinned_answers_warmup()).start()
+
+
+# Current namespace for the answer cache, or None until the first fingerprint is ready
+def get_answer_cache_namespace():
+    return get_namespace_monitor().namespace
+
+
+# Start the warmup the first time the app script runs in this process, off the script
+# thread so the page renders without waiting for it. With the answer cache on, the
+# namespace monitor pre-answers the canned questions; without it there is nowhere to
+# keep the answers, so one question is asked just to open the connections.
+@st.cache_resource
+def start_warmup():
+    if not _warmup_enabled():
+        return None
+    if get_answer_cache() is not None:
+        return get_namespace_monitor()
+    questions = get_canned_questions()
+    if not questions:
+        return None
+    chain = get_retrieval_chain()
+    config = {'callbacks': [get_stage_handler()]}
+
+    def warm():
+        try:
+            chain.invoke({"input": questions[0], "chat_history": []}, config=config)
+        except Exception:
+            logger.exception("Warmup failed")
+
+    thread = threading.Thread(target=warm, name="warmup", daemon=True)
+    thread.start()
+    return thread
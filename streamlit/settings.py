@@ -0,0 +1,14 @@
+import os
+import streamlit as st
+
+
+# Read a setting from Streamlit secrets, falling back to environment variables
+# so the command line tools can run outside of `streamlit run`
+def get_setting(name, default=None):
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except Exception:
+        # no secrets.toml available (e.g. running a script from the terminal)
+        pass
+    return os.environ.get(name, default)
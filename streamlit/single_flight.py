@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import threading
+from embedding_cache import normalize_text
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Questions that differ only in case, spacing or trailing punctuation are the same
+# question. Follow-ups are only the same when the conversation before them is too.
+def flight_key(question, chat_history=()):
+    digest = hashlib.sha256(normalize_text(question).lower().rstrip("?.! ").encode("utf-8"))
+    for message in chat_history:
+        digest.update(b"\0" + str(message.content).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# One in-flight run of the chain. A producer thread records every chunk, so a
+# subscriber that attaches late replays what it missed and then follows live.
+class Flight:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._condition = threading.Condition()
+
+    def publish(self, chunk):
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    def finish(self, error=None):
+        with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    def __iter__(self):
+        position = 0
+        while True:
+            with self._condition:
+                while position >= len(self.chunks) and not self.done:
+                    self._condition.wait()
+                if position < len(self.chunks):
+                    chunk = self.chunks[position]
+                    position += 1
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield chunk
+
+
+# Process-wide single-flight layer: while a question is being answered, identical
+# questions from other sessions attach to the same run and the same token stream
+# instead of starting their own. A flight is forgotten as soon as it finishes; the
+# answer cache covers repeats after that.
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    # Iterate the chunks for `key`, starting `start()` (a function returning the
+    # chunk iterator) only if no flight for the key is running. Returns the chunk
+    # iterator and whether this caller started the flight.
+    def subscribe(self, key, start):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                threading.Thread(target=self._run, args=(key, flight, start),
+                                 name="single-flight", daemon=True).start()
+        metrics.increment("lease_assistant_single_flight_total", {"role": "leader" if leader else "follower"})
+        return iter(flight), leader
+
+    def _run(self, key, flight, start):
+        # runs to completion even if the session that started it goes away, since
+        # other sessions may be following it
+        error = None
+        try:
+            for chunk in start():
+                flight.publish(chunk)
+        except Exception as exc:
+            logger.exception("Single-flight run failed")
+            error = exc
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.finish(error)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
@@ -0,0 +1,185 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.callbacks import BaseCallbackHandler
+from settings import get_setting
+
+# Latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Libraries that log every request at DEBUG/INFO
+NOISY_LOGGERS = ("httpx", "httpcore", "openai", "qdrant_client", "urllib3", "watchdog")
+
+
+# Default to INFO for the app and WARNING for the http/sdk libraries. LOG_LEVEL can
+# still turn everything up when debugging.
+def configure_logging(level=None):
+    level = str(level or get_setting("LOG_LEVEL", "INFO")).upper()
+    logging.basicConfig(level=level)
+    if level != "DEBUG":
+        for name in NOISY_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+
+# Process-wide counters and histograms, exported in the Prometheus text format and,
+# when a path is configured, appended as events to a jsonl file
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.jsonl_path = None
+
+    def increment(self, name, labels=None, value=1.0):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, seconds, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+        self.write_event({"metric": name, "seconds": round(seconds, 6), **(labels or {})})
+
+    def write_event(self, event):
+        if not self.jsonl_path:
+            return
+        line = json.dumps({"ts": time.time(), **event})
+        with self._lock:
+            with open(self.jsonl_path, "a", encoding="utf-8") as sink:
+                sink.write(line + "\n")
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = Metrics()
+
+
+# Time a block of code as one stage of the pipeline
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe("lease_assistant_stage_seconds", time.perf_counter() - start, {"stage": stage})
+
+
+def record_cache(cache, hit):
+    metrics.increment("lease_assistant_cache_total", {"cache": cache, "result": "hit" if hit else "miss"})
+
+
+# Times the chain stages marked with the "stage:..." tags in lease_chain.py and counts
+# the tokens used by each LLM call. Subclasses can override record() to keep raw samples.
+class StageCallbackHandler(BaseCallbackHandler):
+    def __init__(self):
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        metrics.observe("lease_assistant_stage_seconds", seconds, {"stage": stage})
+
+    def _start(self, run_id, tags):
+        for tag in tags or []:
+            if tag.startswith("stage:"):
+                with self._lock:
+                    self._started[run_id] = (tag.split(":", 1)[1], time.perf_counter())
+                return
+
+    def _end(self, run_id):
+        with self._lock:
+            started = self._started.pop(run_id, None)
+        if started is None:
+            return None
+        stage, start = started
+        self.record(stage, time.perf_counter() - start)
+        return stage
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        self._start(run_id, tags)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        stage = self._end(run_id)
+        if stage is None:
+            return
+        usage = None
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or usage
+        if usage:
+            metrics.increment("lease_assistant_tokens_total", {"stage": stage, "kind": "input"},
+                              usage.get("input_tokens", 0))
+            metrics.increment("lease_assistant_tokens_total", {"stage": stage, "kind": "output"},
+                              usage.get("output_tokens", 0))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, tags=None, **kwargs):
+        self._start(run_id, tags)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, tags=None, **kwargs):
+        self._start(run_id, tags)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+
+# Serve the Prometheus text format on /metrics from a daemon thread
+def start_metrics_server(port, host="0.0.0.0"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,63 @@
+from langchain_community.vectorstores import Qdrant
+from qdrant_client import models
+from settings import get_setting
+
+# Candidates fetched from the quantized index per requested result, before rescoring
+# them with the full-precision vectors. Binary codes lose more, so they oversample more.
+DEFAULT_OVERSAMPLING = {"scalar": 2.0, "binary": 3.0}
+
+QUANTIZATION_MODES = ("none", "scalar", "binary")
+
+
+# QDRANT_QUANTIZATION: "none" (default), "scalar" (int8, ~4x smaller) or "binary"
+# (1 bit per dimension, ~32x smaller; best with high-dimensional vectors)
+def get_quantization_mode():
+    mode = str(get_setting("QDRANT_QUANTIZATION", "none")).lower()
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown QDRANT_QUANTIZATION: {mode}")
+    return mode
+
+
+# Quantized vectors are kept in RAM for the search; the originals can stay on disk
+# because they are only read to rescore the final candidates
+def quantization_config(mode):
+    if mode == "scalar":
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=0.99, always_ram=True))
+    if mode == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    return None
+
+
+# Mode of a collection's quantization_config, as read back from Qdrant
+def collection_quantization(config):
+    if isinstance(config, models.ScalarQuantization):
+        return "scalar"
+    if isinstance(config, models.BinaryQuantization):
+        return "binary"
+    return "none"
+
+
+def rescore_params(mode, rescore=True, oversampling=None):
+    if mode == "none":
+        return None
+    oversampling = float(oversampling or get_setting("QDRANT_OVERSAMPLING", DEFAULT_OVERSAMPLING[mode]))
+    return models.SearchParams(quantization=models.QuantizationSearchParams(
+        rescore=rescore, oversampling=oversampling if rescore else None))
+
+
+# Qdrant vector store that searches the quantized index and rescores the oversampled
+# candidates with the original vectors, unless the caller passes its own search_params
+class RescoringQdrant(Qdrant):
+    def __init__(self, *args, search_params=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.search_params = search_params
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, search_params=None, **kwargs):
+        return super().similarity_search_with_score_by_vector(
+            embedding, k, filter=filter, search_params=search_params or self.search_params, **kwargs)
+
+    async def asimilarity_search_with_score_by_vector(self, embedding, k=4, filter=None, search_params=None,
+                                                      **kwargs):
+        return await super().asimilarity_search_with_score_by_vector(
+            embedding, k, filter=filter, search_params=search_params or self.search_params, **kwargs)
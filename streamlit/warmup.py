@@ -0,0 +1,83 @@
+import argparse
+import logging
+import time
+from answer_cache import (SemanticAnswerCache, DEFAULT_CACHE_PATH, DEFAULT_THRESHOLD,
+                          DEFAULT_TTL_HOURS, DEFAULT_MAX_ENTRIES)
+from lease_chain import build_headless_chain, get_answer_namespace, setup_prompt_template
+from rate_limiter import BACKGROUND, priority_scope
+from settings import get_setting
+from telemetry import configure_logging, span
+
+logger = logging.getLogger(__name__)
+
+# Warm a fresh server process before the first user arrives:
+#
+#   python streamlit/warmup.py
+#
+# Building the chain pays for the imports, the client construction and the first TLS
+# handshakes. Each canned question is then answered once and pinned in the answer
+# cache, so the app serves it instantly (marked as pre-answered) until the corpus,
+# prompt or model changes. The app runs the same routine in the background when
+# its process starts (see resources.start_warmup).
+
+# The example queries advertised on the "Accounting Use Cases" tab
+DEFAULT_CANNED_QUESTIONS = (
+    "What are lease components and nonlease components, and how are they identified?",
+    "What are the journal entries required to account for a lease for lessees and lessors?",
+    "What are the steps required in considering a lease modification?",
+    "I don't understand what a sales-type lease is, can you help me understand and explain it like I'm a child?",
+)
+
+
+# CANNED_QUESTIONS overrides the list, one question per line
+def get_canned_questions():
+    configured = get_setting("CANNED_QUESTIONS")
+    if not configured:
+        return list(DEFAULT_CANNED_QUESTIONS)
+    return [line.strip() for line in str(configured).splitlines() if line.strip()]
+
+
+# Answer and pin every canned question that isn't pinned in this namespace yet.
+# Returns the number of answers computed.
+def run_warmup(chain, answer_cache, namespace, questions, config=None):
+    computed = 0
+    for question in questions:
+        if answer_cache.is_pinned(question, namespace):
+            continue
+        start = time.perf_counter()
+        try:
+            with span("warmup"), priority_scope(BACKGROUND):
+                response = chain.invoke({"input": question, "chat_history": []}, config=config)
+        except Exception:
+            # a failed warmup only costs the first user the cold path
+            logger.exception("Warmup failed for %r", question)
+            continue
+        answer_cache.store(question, response["answer"], response["context"], namespace, pinned=True)
+        computed += 1
+        logger.info("Pre-answered %r in %.1fs", question, time.perf_counter() - start)
+    return computed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-answer the canned example questions.")
+    parser.add_argument("--question", action="append", dest="questions",
+                        help="question to pre-answer (repeatable; defaults to the canned questions)")
+    args = parser.parse_args()
+
+    configure_logging()
+    chain, embeddings, client = build_headless_chain()
+    answer_cache = SemanticAnswerCache(
+        get_setting("ANSWER_CACHE_PATH", DEFAULT_CACHE_PATH),
+        embeddings,
+        threshold=get_setting("ANSWER_CACHE_THRESHOLD", DEFAULT_THRESHOLD),
+        ttl_hours=get_setting("ANSWER_CACHE_TTL_HOURS", DEFAULT_TTL_HOURS),
+        max_entries=get_setting("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+    )
+    namespace = get_answer_namespace(setup_prompt_template(), client)
+    questions = args.questions or get_canned_questions()
+    computed = run_warmup(chain, answer_cache, namespace, questions)
+    logger.info("Pre-answered %s new of %s canned questions", computed, len(questions))
+
+
+if __name__ == "__main__":
+    main()